@@ -1,16 +1,21 @@
 """
 FastAPI приложение для виртуальной примерки мебели
 """
+import os
 import time
+import asyncio
+import functools
 import uuid
-import json
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Callable
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse, Response
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, Response
 
 # Проверяем откуда запускается приложение
 import sys
@@ -24,10 +29,18 @@ if str(BASE_DIR) not in sys.path:
 # Импорты - теперь всегда работают из корня проекта
 from backend.services.gpt4_analyzer import GPT4Analyzer
 from backend.services.background_remover import BackgroundRemover
-from backend.services.nano_banana import NanoBananaService
+from backend.services.nano_banana import NanoBananaService, notify_task_finished
 from backend.services.upsell import UpsellService
-from backend.utils.image_utils import save_uploaded_image
+from backend.utils.image_utils import (
+    save_upload_file,
+    get_image_size,
+    ensure_rgb_png,
+    limit_image_size,
+    add_white_background_to_png,
+)
 from backend.utils.load_env import load_environment, get_env_variable, get_env_optional
+from backend.utils.http_session import close_shared_session
+from backend.utils.logger import get_logger
 from backend.models.schemas import (
     CatalogItem,
     ErrorResponse
@@ -37,13 +50,92 @@ from backend import database as db
 # Загружаем переменные окружения
 load_environment()
 
+logger = get_logger("app")
+
 # Инициализация FastAPI
 app = FastAPI(
     title="Furniture Placement API",
     description="AI-powered виртуальная примерка мебели",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson (C) вместо stdlib json: быстрее на больших ответах (каталог, analysis)
+    default_response_class=ORJSONResponse
 )
 
+# Лимит размера одного загружаемого файла (по умолчанию 40 МБ)
+MAX_UPLOAD_BYTES = int(get_env_optional("MAX_UPLOAD_MB") or "40") * 1024 * 1024
+# Лимит тела запроса по endpoint-ам загрузки: мебель — до 5 файлов за раз
+UPLOAD_BODY_LIMITS = {
+    "/api/upload/room": MAX_UPLOAD_BYTES,
+    "/api/upload/furniture": MAX_UPLOAD_BYTES * 5,
+    "/api/catalog": MAX_UPLOAD_BYTES,
+}
+
+
+class _BodyTooLarge(HTTPException):
+    """Тело запроса превысило лимит во время чтения (без Content-Length, например chunked)."""
+
+    def __init__(self):
+        super().__init__(413, "Файл слишком большой")
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Отклоняет слишком большие загрузки: по заголовку Content-Length — ещё до чтения тела
+    (огромный файл не качается и не парсится в multipart — сразу 413). Без Content-Length
+    (chunked) считаем байты по мере получения и обрываем чтение на превышении лимита.
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        limit = self.limits.get(scope["path"])
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                if value.isdigit() and int(value) > limit:
+                    response = ORJSONResponse({"detail": "Файл слишком большой"}, status_code=413)
+                    await response(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # HTTPException: FastAPI пропускает её из разбора формы как есть и отвечает 413
+                    raise _BodyTooLarge()
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except _BodyTooLarge:
+            if response_started:
+                raise
+            response = ORJSONResponse({"detail": "Файл слишком большой"}, status_code=413)
+            await response(scope, receive, send)
+
+
+# Добавляется до CORS, чтобы ответ 413 тоже получил CORS-заголовки
+app.add_middleware(UploadSizeLimitMiddleware, limits=UPLOAD_BODY_LIMITS)
+
 # CORS middleware для работы с frontend
 app.add_middleware(
     CORSMiddleware,
@@ -54,22 +146,130 @@ app.add_middleware(
 )
 
 
-# Учёт визитов в SQLite (data/visits.db) — все обращения к /api/* кроме админки
-@app.middleware("http")
-async def log_visits_middleware(request, call_next):
-    response = await call_next(request)
-    path = request.url.path
-    if path.startswith("/api/") and not path.startswith("/api/admin/"):
-        if path == "/api/generate" and request.method == "POST":
-            pass  # считаем только успешные генерации — логируем внутри endpoint
+class VisitLogMiddleware:
+    """
+    Учёт визитов в SQLite (data/visits.db) — все обращения к /api/* кроме админки.
+    Чистый ASGI: без Request/Response-обёрток BaseHTTPMiddleware; заголовки читаются
+    прямо из scope, а запись в БД уходит в пул потоков и не задерживает ответ.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Статика (/uploads, /results, /catalog), админка и websocket/lifespan — сразу дальше, без разбора заголовков
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        method = scope["method"]
+        if (
+            not path.startswith("/api/")
+            or path.startswith("/api/admin/")
+            # считаем только успешные генерации — логируем внутри endpoint
+            or (path == "/api/generate" and method == "POST")
+            # служебный callback Kie.ai — не посетитель
+            or path == "/api/kie/callback"
+        ):
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+        forwarded = ua = b""
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                forwarded = value
+            elif name == b"user-agent":
+                ua = value
+        ip = forwarded.decode("latin-1").split(",")[0].strip()
+        if not ip and scope.get("client"):
+            ip = scope["client"][0]
+        if _visit_queue is not None:
+            _visit_queue.put_nowait(db.make_visit_row(ip or "?", ua.decode("latin-1"), path, method))
         else:
-            try:
-                ip = request.headers.get("x-forwarded-for", "").split(",")[0].strip() or (request.client.host if request.client else "")
-                ua = request.headers.get("user-agent", "")
-                db.log_visit(ip or "?", ua, path, request.method)
-            except Exception:
-                pass
-    return response
+            # Фоновый сброс ещё не запущен (startup не выполнялся) — пишем сразу
+            # (ошибки записи log_visit сам пишет в лог приложения)
+            asyncio.get_running_loop().run_in_executor(
+                None, db.log_visit, ip or "?", ua.decode("latin-1"), path, method
+            )
+
+
+app.add_middleware(VisitLogMiddleware)
+
+
+class ApiGZipMiddleware:
+    """
+    GZip только для JSON-ответов /api/* (каталог, визиты, анализ) — сжимаются в 3–10 раз.
+    Картинки (static и /api/catalog/img/) уже сжаты PNG — тратить на них CPU незачем.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, compresslevel: int = 5):
+        self.app = app
+        self.gzip = GZipMiddleware(app, minimum_size=minimum_size, compresslevel=compresslevel)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            path = scope["path"]
+            if path.startswith("/api/") and not path.startswith("/api/catalog/img/"):
+                await self.gzip(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(ApiGZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# Визиты копятся в очереди и пишутся пачками: одна транзакция SQLite на пачку, а не на запрос
+VISIT_FLUSH_INTERVAL = 0.25
+VISIT_BATCH_SIZE = 500
+_visit_queue: Optional[asyncio.Queue] = None
+_visit_flusher: Optional[asyncio.Task] = None
+
+
+def _drain_visit_queue(rows: List[tuple]) -> List[tuple]:
+    """Добирает из очереди уже накопившиеся визиты (не больше VISIT_BATCH_SIZE)."""
+    while len(rows) < VISIT_BATCH_SIZE and not _visit_queue.empty():
+        rows.append(_visit_queue.get_nowait())
+    return rows
+
+
+async def _flush_visits_loop():
+    """Ждёт первый визит, даёт очереди накопиться VISIT_FLUSH_INTERVAL и пишет пачку в пуле потоков."""
+    loop = asyncio.get_running_loop()
+    while True:
+        rows = [await _visit_queue.get()]
+        try:
+            await asyncio.sleep(VISIT_FLUSH_INTERVAL)
+        except asyncio.CancelledError:
+            db.log_visits(_drain_visit_queue(rows))
+            raise
+        await loop.run_in_executor(None, db.log_visits, _drain_visit_queue(rows))
+
+
+@app.on_event("startup")
+async def start_visit_flusher():
+    global _visit_queue, _visit_flusher
+    _visit_queue = asyncio.Queue()
+    _visit_flusher = asyncio.create_task(_flush_visits_loop())
+
+
+@app.on_event("shutdown")
+async def stop_visit_flusher():
+    """Останавливает фоновый сброс и синхронно дописывает всё, что осталось в очереди."""
+    if _visit_flusher is None:
+        return
+    _visit_flusher.cancel()
+    try:
+        await _visit_flusher
+    except asyncio.CancelledError:
+        pass
+    while not _visit_queue.empty():
+        db.log_visits(_drain_visit_queue([]))
+
+
+@app.on_event("shutdown")
+async def close_http_sessions():
+    """Закрывает keep-alive соединения общей HTTP-сессии (Kie.ai, ImgBB)."""
+    close_shared_session()
+
 
 # Директории (BASE_DIR уже определен выше)
 DATA_DIR = BASE_DIR / "data"
@@ -78,55 +278,161 @@ RESULTS_DIR = DATA_DIR / "results"
 CATALOG_DIR = DATA_DIR / "catalog"
 CATALOG_DB_FILE = DATA_DIR / "catalog.json"
 
-# Создаем директории если не существуют
-UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
-RESULTS_DIR.mkdir(parents=True, exist_ok=True)
-CATALOG_DIR.mkdir(parents=True, exist_ok=True)
+# Типы загружаемых файлов, которые умеет открыть PIL (HEIC без плагина не читается, SVG — не растр)
+ALLOWED_IMAGE_TYPES = frozenset({
+    "image/jpeg",
+    "image/jpg",
+    "image/png",
+    "image/webp",
+    "image/gif",
+    "image/bmp",
+})
+
+
+def check_upload_size(file: UploadFile) -> None:
+    """
+    Проверяет размер уже принятого файла (на случай, если Content-Length не был
+    передан или занижен — например, при chunked-загрузке). 413 если больше лимита.
+    """
+    size = file.size
+    if size is None:
+        size = int(file.headers.get("content-length") or 0)
+    if size > MAX_UPLOAD_BYTES:
+        raise HTTPException(413, f"Файл слишком большой (максимум {MAX_UPLOAD_BYTES // (1024 * 1024)} МБ)")
+
+# Создаем директории если не существуют (при перезапусках с --reload они уже есть — один stat на каждую)
+for _dir in (UPLOADS_DIR, RESULTS_DIR, CATALOG_DIR):
+    if not _dir.is_dir():
+        _dir.mkdir(parents=True, exist_ok=True)
 
 # Загружаем каталог из файла
+def _loads(value: Any) -> Any:
+    """JSON из поля формы (orjson); уже разобранные значения возвращает как есть."""
+    return orjson.loads(value) if isinstance(value, (str, bytes)) else value
+
+
+# Разобранный catalog.json и mtime, с которым он был прочитан
+_CATALOG_CACHE: Dict[str, Any] = {"mtime": None, "data": []}
+
+
 def load_catalog() -> List[Dict[str, Any]]:
-    """Загружает каталог из JSON файла"""
-    if CATALOG_DB_FILE.exists():
-        try:
-            with open(CATALOG_DB_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"⚠️  Ошибка загрузки каталога: {e}")
-    return []
+    """Загружает каталог из JSON файла (повторно не читает, пока файл не изменился)"""
+    try:
+        mtime = CATALOG_DB_FILE.stat().st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if _CATALOG_CACHE["mtime"] == mtime:
+        return _CATALOG_CACHE["data"]
+    try:
+        data = orjson.loads(CATALOG_DB_FILE.read_bytes())
+    except Exception as e:
+        logger.warning("⚠️  Ошибка загрузки каталога: %s", e)
+        return []
+    _CATALOG_CACHE["mtime"] = mtime
+    _CATALOG_CACHE["data"] = data
+    return data
 
 def save_catalog(items: List[Dict[str, Any]]):
-    """Сохраняет каталог в JSON файл"""
+    """Сохраняет каталог в JSON файл (через временный файл — при сбое старый каталог не портится)"""
+    tmp_file = CATALOG_DB_FILE.with_suffix(".json.tmp")
     try:
-        with open(CATALOG_DB_FILE, 'w', encoding='utf-8') as f:
-            json.dump(items, f, ensure_ascii=False, indent=2)
+        tmp_file.write_bytes(orjson.dumps(items, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_file, CATALOG_DB_FILE)
+        _CATALOG_CACHE["mtime"] = CATALOG_DB_FILE.stat().st_mtime_ns
+        _CATALOG_CACHE["data"] = items
     except Exception as e:
-        print(f"⚠️  Ошибка сохранения каталога: {e}")
+        logger.warning("⚠️  Ошибка сохранения каталога: %s", e)
 
 # Загружаем каталог при старте
-CATALOG_ITEMS: List[Dict[str, Any]] = load_catalog()
+# Каталог в памяти: id -> товар (порядок вставки сохраняется — как в catalog.json).
+# Добавление и удаление по id — O(1); товары без id (ручная правка файла) получают новый
+CATALOG_ITEMS: Dict[str, Dict[str, Any]] = {
+    item.setdefault("id", str(uuid.uuid4())): item for item in load_catalog()
+}
+
+# Файлы каталога: имя -> путь. Один проход по data/catalog при старте вместо stat на каждый запрос
+CATALOG_FILES: Dict[str, Path] = {f.name: f for f in CATALOG_DIR.iterdir() if f.is_file()}
+
+
+def find_catalog_file(name: str) -> Optional[Path]:
+    """Файл каталога по имени. Если его нет в таблице (положили вручную) — проверяем диск и дописываем."""
+    path = CATALOG_FILES.get(name)
+    if path is None:
+        candidate = CATALOG_DIR / name
+        if candidate.is_file():
+            CATALOG_FILES[name] = path = candidate
+    return path
 
 # Инициализация БД визитов (SQLite: data/visits.db)
 db.init_db()
 
 
-def resolve_furniture_path(path: str) -> str:
+def _resolve_cached(finder: Callable[[str], str], path: str) -> str:
     """
-    Преобразует путь к мебели в путь на текущей машине.
-    В catalog.json могут быть абсолютные пути с другого ПК или относительные (catalog/xxx.png).
+    Резолвит путь через finder с lru_cache: повторный запрос того же пути — один stat
+    (проверка, что файл на месте) вместо трёх-четырёх. Ненайденные пути не кэшируются
+    (finder бросает FileNotFoundError), так что только что загруженный файл находится сразу.
     """
+    try:
+        resolved = finder(path)
+        if os.path.exists(resolved):
+            return resolved
+        # Файл удалили после кэширования — забываем старые ответы и ищем заново
+        finder.cache_clear()
+        return finder(path)
+    except FileNotFoundError:
+        return str(path)
+
+
+@functools.lru_cache(maxsize=4096)
+def _find_furniture_path(path: str) -> str:
     p = Path(path)
+    # Файл каталога (catalog/xxx.png или путь с другого ПК) — по имени из таблицы, без stat
+    catalog_file = CATALOG_FILES.get(p.name)
+    if catalog_file is not None:
+        return str(catalog_file)
     if p.is_absolute() and p.exists():
         return str(p)
     # Относительный путь (catalog/xxx.png) или только имя файла
     for candidate in (DATA_DIR / path, CATALOG_DIR / p.name):
         if candidate.exists():
             return str(candidate)
-    return str(path)
+    raise FileNotFoundError(path)
+
+
+def resolve_furniture_path(path: str) -> str:
+    """
+    Преобразует путь к мебели в путь на текущей машине.
+    В catalog.json могут быть абсолютные пути с другого ПК или относительные (catalog/xxx.png).
+    """
+    return _resolve_cached(_find_furniture_path, path)
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles с заголовком Cache-Control: браузер не запрашивает файл повторно.
+    Имена загрузок и результатов — UUID, содержимое по имени не меняется (immutable).
+    """
+    
+    def __init__(self, *args, cache_control: str = "public, max-age=31536000, immutable", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+    
+    def file_response(self, *args, **kwargs) -> Response:
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = self.cache_control
+        return response
+
 
 # Монтируем статические файлы
-app.mount("/results", StaticFiles(directory=str(RESULTS_DIR)), name="results")
-app.mount("/catalog", StaticFiles(directory=str(CATALOG_DIR)), name="catalog")
-app.mount("/uploads", StaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
+RESULTS_URL_PREFIX = "/results/"
+app.mount(RESULTS_URL_PREFIX.rstrip("/"), CachedStaticFiles(directory=str(RESULTS_DIR)), name="results")
+# Каталог: /api/catalog/fix-backgrounds перезаписывает файлы на месте — кэшируем на сутки, не навсегда
+app.mount(
+    "/catalog",
+    CachedStaticFiles(directory=str(CATALOG_DIR), cache_control="public, max-age=86400"),
+    name="catalog"
+)
+app.mount("/uploads", CachedStaticFiles(directory=str(UPLOADS_DIR)), name="uploads")
 
 # Инициализация сервисов
 gpt4_analyzer = GPT4Analyzer()
@@ -134,23 +440,90 @@ background_remover = BackgroundRemover(use_api=False)  # Используем re
 inpainting_service = NanoBananaService()
 upsell_service = UpsellService()
 
+# Свойства модели постоянны на время жизни процесса — читаем один раз
+INPAINTING_MODEL_NAME = inpainting_service.get_model_name()
+INPAINTING_PRESERVES_ORIGINAL = inpainting_service.preserves_original()
+
+# Пул для блокирующих вызовов сервисов (rembg, запросы к Kie.ai и опрос задач).
+# Пока они выполняются, event loop обслуживает другие запросы (каталог, health, загрузки).
+# Потоки, а не процессы: работа — в основном ожидание сети, а onnxruntime/PIL отпускают GIL.
+BLOCKING_POOL = ThreadPoolExecutor(
+    max_workers=int(get_env_optional("WORKER_THREADS") or max(4, os.cpu_count() or 1)),
+    thread_name_prefix="mebel-worker"
+)
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """Выполняет синхронную функцию в BLOCKING_POOL и ждёт результат, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(BLOCKING_POOL, functools.partial(func, *args, **kwargs))
+
+
+# Отдельный пул для генераций Nano Banana: задача Kie.ai идёт 60–120 сек, и почти всё это время поток
+# спит между опросами. В общем пуле несколько одновременных генераций заняли бы все потоки,
+# и rembg/уменьшение результата ждали бы их окончания. Спящий поток дешёвый — потоков здесь больше.
+GENERATION_POOL = ThreadPoolExecutor(
+    max_workers=int(get_env_optional("GENERATION_THREADS") or 16),
+    thread_name_prefix="mebel-generation"
+)
+
+
+async def run_generation(func: Callable, *args, **kwargs):
+    """Как run_blocking, но в GENERATION_POOL — для долгих вызовов inpainting_service (ожидание задачи Kie.ai)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(GENERATION_POOL, functools.partial(func, *args, **kwargs))
+
+
+def _file_mtime(path: str) -> float:
+    """mtime файла для ключей кэша (0.0 если файла нет)."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
+
+
+@functools.lru_cache(maxsize=256)
+def _image_size(path: str, mtime: float) -> Tuple[int, int]:
+    """Размер изображения; mtime в ключе — чтобы перезаписанный файл не отдавал старый размер."""
+    return get_image_size(path)
+
+
+@functools.lru_cache(maxsize=256)
+def _catalog_png_bytes(path: str, mtime_ns: int) -> bytes:
+    """PNG каталога с белым фоном; mtime в ключе — после fix-backgrounds/перезаписи пересчитывается."""
+    return ensure_rgb_png(path)
+
+
+# Ответы служебных endpoints не меняются за время жизни процесса — собираем один раз
+ROOT_INFO: Dict[str, Any] = {
+    "message": "🛋️ Furniture Placement API",
+    "version": "1.0.0",
+    "endpoints": {
+        "admin_visits": "/api/admin/visits",
+        "upload_room": "/api/upload/room",
+        "upload_furniture": "/api/upload/furniture",
+        "analyze_room_replace": "/api/analyze-room-replace",
+        "generate": "/api/generate",
+        "catalog": "/api/catalog",
+        "upsell": "/api/upsell"
+    }
+}
+
+HEALTH_STATUS: Dict[str, Any] = {
+    "status": "healthy",
+    "services": {
+        "gpt4_vision": "ready",
+        "background_removal": "ready",
+        "inpainting": "ready",
+        "upsell": "ready"
+    }
+}
+
 
 @app.get("/")
 async def root():
     """Главная страница API"""
-    return {
-        "message": "🛋️ Furniture Placement API",
-        "version": "1.0.0",
-        "endpoints": {
-            "admin_visits": "/api/admin/visits",
-            "upload_room": "/api/upload/room",
-            "upload_furniture": "/api/upload/furniture",
-            "analyze_room_replace": "/api/analyze-room-replace",
-            "generate": "/api/generate",
-            "catalog": "/api/catalog",
-            "upsell": "/api/upsell"
-        }
-    }
+    return ROOT_INFO
 
 
 @app.get("/api/admin/visits")
@@ -169,7 +542,7 @@ async def admin_get_visits(
     provided = x_admin_key or key
     if provided != admin_key:
         raise HTTPException(403, "Неверный ключ доступа")
-    visits = db.get_visits(limit=limit)
+    visits = await run_blocking(db.get_visits, limit=limit)
     return {"success": True, "visits": visits, "total": len(visits)}
 
 
@@ -177,7 +550,7 @@ async def admin_get_visits(
 async def trial_status(request: Request):
     """Возвращает сколько визуализаций уже использовано и лимит (по IP)."""
     client_ip = (request.headers.get("x-forwarded-for") or "").strip().split(",")[0].strip() or (request.client.host if request.client else "")
-    used = db.get_generate_count(client_ip)
+    used = await run_blocking(db.get_generate_count, client_ip)
     return {"used": used, "limit": TRIAL_LIMIT, "remaining": max(0, TRIAL_LIMIT - used)}
 
 
@@ -188,19 +561,21 @@ async def upload_room(file: UploadFile = File(...)):
     """
     try:
         # Проверка типа файла
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(400, "Файл должен быть изображением")
+        if (file.content_type or "") not in ALLOWED_IMAGE_TYPES:
+            raise HTTPException(415, "Файл должен быть изображением (JPEG, PNG, WebP, GIF, BMP)")
+        check_upload_size(file)
         
-        # Сохраняем изображение
-        image_data = await file.read()
-        file_path = save_uploaded_image(image_data, UPLOADS_DIR)
+        # Сохраняем изображение (потоково из спула, без чтения в память)
+        file_path, filename = await save_upload_file(file, UPLOADS_DIR, BLOCKING_POOL)
         
         return {
             "success": True,
             "file_path": file_path,
-            "filename": Path(file_path).name
+            "filename": filename
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Ошибка загрузки: {str(e)}")
 
@@ -214,18 +589,21 @@ async def upload_furniture(files: List[UploadFile] = File(...)):
         if len(files) > 5:
             raise HTTPException(400, "Максимум 5 предметов мебели за раз")
         
-        results = []
-        
+        # Сначала проверяем все файлы — чтобы при ошибке ничего не сохранять
         for file in files:
-            if not file.content_type.startswith('image/'):
-                raise HTTPException(400, f"Файл {file.filename} должен быть изображением")
-            
-            image_data = await file.read()
-            file_path = save_uploaded_image(image_data, UPLOADS_DIR)
-            print(f"📷 Мебель загружена (без удаления фона): {file.filename}")
+            if (file.content_type or "") not in ALLOWED_IMAGE_TYPES:
+                raise HTTPException(415, f"Файл {file.filename} должен быть изображением (JPEG, PNG, WebP, GIF, BMP)")
+            check_upload_size(file)
+        
+        # Декодирование/перекодирование в PNG — параллельно в пуле потоков (имена файлов — uuid, не пересекаются)
+        saved = await asyncio.gather(*(save_upload_file(file, UPLOADS_DIR, BLOCKING_POOL) for file in files))
+        
+        results = []
+        for file, (file_path, filename) in zip(files, saved):
+            logger.info("📷 Мебель загружена (без удаления фона): %s", file.filename)
             results.append({
                 "file_path": file_path,
-                "filename": Path(file_path).name,
+                "filename": filename,
                 "background_removed": False,
             })
         
@@ -235,19 +613,26 @@ async def upload_furniture(files: List[UploadFile] = File(...)):
             "count": len(results)
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Ошибка загрузки: {str(e)}")
 
 
-def resolve_room_path(path: str) -> str:
-    """Путь к фото комнаты: абсолютный или относительно data/uploads."""
+@functools.lru_cache(maxsize=4096)
+def _find_room_path(path: str) -> str:
     p = Path(path)
     if p.is_absolute() and p.exists():
         return str(p)
     for candidate in (DATA_DIR / path, UPLOADS_DIR / p.name):
         if candidate.exists():
             return str(candidate)
-    return str(path)
+    raise FileNotFoundError(path)
+
+
+def resolve_room_path(path: str) -> str:
+    """Путь к фото комнаты: абсолютный или относительно data/uploads."""
+    return _resolve_cached(_find_room_path, path)
 
 
 @app.post("/api/analyze-room-replace")
@@ -258,7 +643,7 @@ async def analyze_room_for_replace(room_image_path: str = Form(...)):
     """
     try:
         room_path = resolve_room_path(room_image_path)
-        result = gpt4_analyzer.analyze_room_for_replace(room_path)
+        result = await run_blocking(gpt4_analyzer.analyze_room_for_replace, room_path)
         return result
     except Exception as e:
         raise HTTPException(500, f"Ошибка анализа комнаты: {str(e)}")
@@ -295,9 +680,23 @@ async def generate_placement(
     placement_mode=replace: комната со старой мебелью + один новый предмет → замена.
     """
     try:
-        import json
+        # Проверка аргументов — до запроса к БД и до любых обращений к диску
+        try:
+            furniture_paths = orjson.loads(furniture_image_paths)
+        except orjson.JSONDecodeError:
+            raise HTTPException(400, "furniture_image_paths должен быть JSON-массивом")
+        if not isinstance(furniture_paths, list) or len(furniture_paths) == 0:
+            raise HTTPException(400, "furniture_image_paths должен быть непустым массивом")
+        replace_mode = (placement_mode or "").strip().lower() == "replace"
+        if len(furniture_paths) > 5:
+            if replace_mode:
+                raise HTTPException(400, "В режиме «Заменить мебель» выберите от 1 до 5 предметов (новую мебель)")
+            raise HTTPException(400, "Максимум 5 предметов мебели")
+        if not replace_mode and furniture_rotation not in (0, 90):
+            raise HTTPException(400, "furniture_rotation должен быть 0 или 90")
+        
         client_ip = (request.headers.get("x-forwarded-for") or "").strip().split(",")[0].strip() or (request.client.host if request.client else "")
-        used = db.get_generate_count(client_ip)
+        used = await run_blocking(db.get_generate_count, client_ip)
         if used >= TRIAL_LIMIT:
             raise HTTPException(
                 403,
@@ -305,59 +704,51 @@ async def generate_placement(
             )
         start_time = time.time()
         
-        furniture_paths = json.loads(furniture_image_paths)
-        if not isinstance(furniture_paths, list) or len(furniture_paths) == 0:
-            raise HTTPException(400, "furniture_image_paths должен быть непустым массивом")
         furniture_paths = [resolve_furniture_path(p) for p in furniture_paths]
         
-        # Режим «Заменить мебель»: 1–3 предмета, replace_what через запятую
-        if (placement_mode or "").strip().lower() == "replace":
-            if len(furniture_paths) < 1 or len(furniture_paths) > 5:
-                raise HTTPException(400, "В режиме «Заменить мебель» выберите от 1 до 5 предметов (новую мебель)")
+        # Режим «Заменить мебель»: 1–5 предметов, replace_what через запятую
+        if replace_mode:
             replace_hint = (replace_what or "").strip() or None
-            print(f"🔄 Режим замены: подставляем новую мебель вместо старой" + (f" ({replace_hint})" if replace_hint else "") + "...")
+            logger.info("🔄 Режим замены: подставляем новую мебель вместо старой%s...", f" ({replace_hint})" if replace_hint else "")
             if len(furniture_paths) == 1:
-                result_path = inpainting_service.place_furniture_replace(
+                result_path = await run_generation(
+                    inpainting_service.place_furniture_replace,
                     resolve_room_path(room_image_path),
                     furniture_paths[0],
                     RESULTS_DIR,
                     replace_what=replace_hint
                 )
             else:
-                result_path = inpainting_service.place_furniture_replace_multi(
+                result_path = await run_generation(
+                    inpainting_service.place_furniture_replace_multi,
                     resolve_room_path(room_image_path),
                     furniture_paths,
                     RESULTS_DIR,
                     replace_what=replace_hint
                 )
-            from backend.utils.image_utils import limit_image_size
-            result_path = limit_image_size(result_path, max_long_side=1200)
-            result_filename = Path(result_path).name
-            result_url = f"/results/{result_filename}"
+            result_path = await run_blocking(limit_image_size, result_path, max_long_side=1200)
+            result_url = RESULTS_URL_PREFIX + os.path.basename(result_path)
             generation_time = time.time() - start_time
-            print(f"✅ Замена завершена за {generation_time:.2f}с")
+            logger.info("✅ Замена завершена за %.2fс", generation_time)
             analysis = {
                 "room_analysis": {"style": "modern", "lighting": "natural"},
                 "furniture_analysis": {"type": "мебель", "style": "современный", "color": "нейтральный"},
                 "furniture_items": [{"index": 0, "type": "мебель", "placement": {}}]
             }
             try:
-                db.log_visit(client_ip, request.headers.get("user-agent", ""), "/api/generate", "POST")
+                await run_blocking(db.log_visit, client_ip, request.headers.get("user-agent", ""), "/api/generate", "POST")
             except Exception:
                 pass
-            return {
+            return ORJSONResponse({
                 "success": True,
                 "result_image_path": result_path,
                 "result_image_url": result_url,
                 "generation_time": generation_time,
-                "model_used": inpainting_service.get_model_name(),
+                "model_used": INPAINTING_MODEL_NAME,
                 "preserves_original": False,
                 "analysis": analysis,
                 "furniture_count": len(furniture_paths)
-            }
-        
-        if len(furniture_paths) > 5:
-            raise HTTPException(400, "Максимум 5 предметов мебели")
+            })
         
         manual_position = None
         manual_box = None
@@ -371,15 +762,18 @@ async def generate_placement(
                 manual_position = (manual_x, manual_y)
         
         # Шаг 1: Анализ с Gemini Vision (при ошибке — запасной режим без AI)
-        print(f"🔍 Анализ комнаты и {len(furniture_paths)} предмет(ов) мебели...")
+        logger.info("🔍 Анализ комнаты и %d предмет(ов) мебели...", len(furniture_paths))
         try:
-            analysis = gpt4_analyzer.analyze_multi_furniture_placement(
+            # Повтор с другим поворотом/стеной не вызывает Gemini заново: анализатор кэширует по содержимому файлов
+            # (запасной «Default placement» не кэширует) и отдаёт копию — дополнять её параметрами запроса можно
+            analysis = await run_blocking(
+                gpt4_analyzer.analyze_multi_furniture_placement,
                 room_image_path,
                 furniture_paths,
                 manual_position
             )
         except Exception as e:
-            print(f"⚠️  Gemini недоступен ({e}), используем стандартное размещение")
+            logger.warning("⚠️  Gemini недоступен (%s), используем стандартное размещение", e)
             n = len(furniture_paths)
             analysis = {
                 "room_analysis": {"style": "modern", "lighting": "natural"},
@@ -403,9 +797,7 @@ async def generate_placement(
 
         # Если пользователь указал прямоугольник — используем его
         if manual_box is not None:
-            from PIL import Image
-            room_img = Image.open(room_image_path)
-            rw, rh = room_img.size
+            rw, rh = _image_size(room_image_path, _file_mtime(room_image_path))
             bx, by, bw, bh = manual_box
             # clamp
             bx = max(0, min(bx, rw - 1))
@@ -436,15 +828,14 @@ async def generate_placement(
                     wall_alignment = "back"
 
         # Поворот и wall alignment
-        if furniture_rotation not in (0, 90):
-            raise HTTPException(400, "furniture_rotation должен быть 0 или 90")
         analysis.setdefault("placement", {})
         analysis["placement"]["rotation"] = furniture_rotation
         analysis["placement"]["wall_alignment"] = wall_alignment
         
         # Шаг 2: Размещение мебели (последовательно или композитом)
-        print(f"🍌 Размещение {len(furniture_paths)} предмет(ов) мебели...")
-        result_path = inpainting_service.place_multi_furniture(
+        logger.info("🍌 Размещение %d предмет(ов) мебели...", len(furniture_paths))
+        result_path = await run_generation(
+            inpainting_service.place_multi_furniture,
             room_image_path,
             furniture_paths,
             analysis,
@@ -452,37 +843,55 @@ async def generate_placement(
         )
         
         # Ограничиваем размер результата (макс. 1200px по длинной стороне)
-        from backend.utils.image_utils import limit_image_size
-        result_path = limit_image_size(result_path, max_long_side=1200)
+        result_path = await run_blocking(limit_image_size, result_path, max_long_side=1200)
         
         # Формируем URL для доступа к результату
-        result_filename = Path(result_path).name
-        result_url = f"/results/{result_filename}"
+        result_url = RESULTS_URL_PREFIX + os.path.basename(result_path)
         
         generation_time = time.time() - start_time
         
-        print(f"✅ Генерация завершена за {generation_time:.2f}с")
+        logger.info("✅ Генерация завершена за %.2fс", generation_time)
         
         try:
-            db.log_visit(client_ip, request.headers.get("user-agent", ""), "/api/generate", "POST")
+            await run_blocking(db.log_visit, client_ip, request.headers.get("user-agent", ""), "/api/generate", "POST")
         except Exception:
             pass
-        return {
+        return ORJSONResponse({
             "success": True,
             "result_image_path": result_path,
             "result_image_url": result_url,
             "generation_time": generation_time,
-            "model_used": inpainting_service.get_model_name(),
-            "preserves_original": inpainting_service.preserves_original(),
+            "model_used": INPAINTING_MODEL_NAME,
+            "preserves_original": INPAINTING_PRESERVES_ORIGINAL,
             "analysis": analysis,
             "furniture_count": len(furniture_paths)
-        }
+        })
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Ошибка генерации: {e}")
+        logger.error("❌ Ошибка генерации: %s", e)
         raise HTTPException(500, f"Ошибка генерации: {str(e)}")
 
 
+@app.post("/api/kie/callback")
+async def kie_task_callback(request: Request):
+    """
+    Callback Kie.ai о завершении задачи генерации (адрес задаётся в KIE_CALLBACK_URL).
+    Только будит ожидающий опрос: результат забирается через recordInfo, поэтому чужой callback
+    стоит не больше одного лишнего опроса.
+    """
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(400, "Ожидается JSON")
+    data = body.get("data") if isinstance(body, dict) else None
+    task_id = (data or {}).get("taskId") if isinstance(data, dict) else None
+    if not task_id:
+        raise HTTPException(400, "Нет taskId")
+    return {"success": True, "waiting": notify_task_finished(str(task_id))}
+
+
 @app.post("/api/upsell")
 async def get_upsell_recommendations(
     furniture_analysis: str = Form(...),
@@ -493,25 +902,27 @@ async def get_upsell_recommendations(
     Рекомендации допродаж из каталога: только то, что реально подойдёт.
     exclude_paths — JSON-массив путей к мебели, которую уже разместили (не рекомендуем её снова).
     """
+    # Пустой каталог — отвечаем сразу, без разбора JSON из формы
+    if not CATALOG_ITEMS:
+        return {"success": True, "recommendations": []}
+    catalog = list(CATALOG_ITEMS.values())
+    
     try:
-        furniture_data = json.loads(furniture_analysis) if isinstance(furniture_analysis, str) else furniture_analysis
-        room_data = json.loads(room_analysis) if isinstance(room_analysis, str) else room_analysis
-        exclude_list = json.loads(exclude_paths) if isinstance(exclude_paths, str) and exclude_paths.strip() else []
+        furniture_data = _loads(furniture_analysis)
+        room_data = _loads(room_analysis)
+        exclude_list = orjson.loads(exclude_paths) if isinstance(exclude_paths, str) and exclude_paths.strip() else []
         if not isinstance(exclude_list, list):
             exclude_list = []
-    except (json.JSONDecodeError, TypeError):
+    except (orjson.JSONDecodeError, TypeError):
         furniture_data = {}
         room_data = {}
         exclude_list = []
     
     try:
-        if not CATALOG_ITEMS:
-            return {"success": True, "recommendations": []}
-        
         recommendations = upsell_service.generate_recommendations(
             furniture_data,
             room_data,
-            CATALOG_ITEMS,
+            catalog,
             max_recommendations=4,
             exclude_item_paths=exclude_list
         )
@@ -521,7 +932,7 @@ async def get_upsell_recommendations(
             room_style = room_data.get("style", "") if isinstance(room_data, dict) else ""
             simple_recs = upsell_service.get_simple_recommendations(
                 furniture_type,
-                CATALOG_ITEMS,
+                catalog,
                 count=4,
                 exclude_item_paths=exclude_list,
                 room_style=room_style
@@ -530,7 +941,7 @@ async def get_upsell_recommendations(
         
         # Если нечего рекомендовать (всё из каталога уже применили) — сообщение пользователю
         message = None
-        if not recommendations and CATALOG_ITEMS:
+        if not recommendations and catalog:
             message = (
                 "Вы уже применили все предметы из каталога. "
                 "Добавьте в каталог светильники, тумбочки, стулья, столы — и появятся новые рекомендации."
@@ -538,12 +949,12 @@ async def get_upsell_recommendations(
         return {"success": True, "recommendations": recommendations, "message": message}
         
     except Exception as e:
-        print(f"⚠️  Ошибка генерации рекомендаций: {e}")
+        logger.warning("⚠️  Ошибка генерации рекомендаций: %s", e)
         furniture_type = furniture_data.get("type", "мебель") if isinstance(furniture_data, dict) else "мебель"
         room_style = room_data.get("style", "") if isinstance(room_data, dict) else ""
         simple_recs = upsell_service.get_simple_recommendations(
             furniture_type,
-            CATALOG_ITEMS,
+            catalog,
             count=4,
             exclude_item_paths=exclude_list,
             room_style=room_style
@@ -551,7 +962,7 @@ async def get_upsell_recommendations(
         message = (
             "Вы уже применили все предметы из каталога. "
             "Добавьте в каталог светильники, тумбочки, стулья, столы — и появятся новые рекомендации."
-        ) if not simple_recs and CATALOG_ITEMS else None
+        ) if not simple_recs and catalog else None
         return {"success": True, "recommendations": simple_recs, "message": message}
 
 
@@ -560,35 +971,72 @@ async def get_catalog():
     """
     Получить каталог доступной мебели
     """
-    return {
+    # Готовый ORJSONResponse не проходит через jsonable_encoder в FastAPI
+    return ORJSONResponse({
         "success": True,
-        "items": CATALOG_ITEMS
-    }
+        "items": list(CATALOG_ITEMS.values())
+    })
 
 
 @app.get("/api/catalog/img/{filename}")
-async def get_catalog_image(filename: str):
+async def get_catalog_image(filename: str, request: Request):
     """
     Отдать изображение каталога с белым фоном (без прозрачности).
     Всегда возвращает PNG без альфа-канала — без «шахматной доски».
+    Готовые байты кэшируются в памяти по (путь, mtime); ETag позволяет браузеру получить 304.
     """
     # Убираем query string (?v=2) если есть
     safe_name = Path(filename.split("?")[0]).name
-    file_path = CATALOG_DIR / safe_name
-    if not file_path.exists():
+    file_path = find_catalog_file(safe_name)
+    if file_path is None:
         raise HTTPException(404, "Изображение не найдено")
     try:
-        from backend.utils.image_utils import ensure_rgb_png
-        png_bytes = ensure_rgb_png(str(file_path))
+        mtime_ns = file_path.stat().st_mtime_ns
+        etag = f'W/"{mtime_ns}"'
+        headers = {"Cache-Control": "public, max-age=86400", "ETag": etag}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        png_bytes = await run_blocking(_catalog_png_bytes, str(file_path), mtime_ns)
         return Response(
             content=png_bytes,
             media_type="image/png",
-            headers={"Cache-Control": "public, max-age=3600"}
+            headers=headers
         )
+    except FileNotFoundError:
+        # Файл удалили с диска в обход API
+        CATALOG_FILES.pop(safe_name, None)
+        raise HTTPException(404, "Изображение не найдено")
     except Exception as e:
         raise HTTPException(500, f"Ошибка обработки изображения: {e}")
 
 
+def _process_catalog_image(file_path: str) -> str:
+    """Удаляет фон (если установлен rembg) и подкладывает белый фон. Блокирующая — вызывать через run_blocking."""
+    file_path_no_bg = background_remover.remove_background(file_path)
+    # ВАЖНО: Добавляем белый фон к PNG с прозрачностью (убираем "шахматную доску")
+    return add_white_background_to_png(file_path_no_bg)
+
+
+def _fix_catalog_backgrounds_sync() -> int:
+    """
+    Подкладывает белый фон ко всем найденным изображениям каталога.
+    Файлы обрабатываются параллельно (PIL отпускает GIL при декодировании и записи PNG);
+    каждый путь — один раз, чтобы два потока не писали в один файл.
+    """
+    resolved_paths = (
+        resolve_furniture_path(item["image_path"])
+        for item in list(CATALOG_ITEMS.values())
+        if item.get("image_path")
+    )
+    paths = {path for path in resolved_paths if os.path.exists(path)}
+    if not paths:
+        return 0
+    workers = min(8, (os.cpu_count() or 1) * 2, len(paths))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mebel-fix-bg") as pool:
+        futures = [pool.submit(add_white_background_to_png, path) for path in paths]
+        return sum(1 for _ in as_completed(futures))
+
+
 @app.post("/api/catalog")
 async def add_catalog_item(
     name: str = Form(...),
@@ -602,20 +1050,19 @@ async def add_catalog_item(
     Добавить товар в каталог
     """
     try:
-        # Сохраняем изображение
-        image_data = await file.read()
-        file_path = save_uploaded_image(image_data, CATALOG_DIR)
+        if (file.content_type or "") not in ALLOWED_IMAGE_TYPES:
+            raise HTTPException(415, "Файл должен быть изображением (JPEG, PNG, WebP, GIF, BMP)")
+        check_upload_size(file)
         
-        # Удаляем фон (если установлен rembg)
-        file_path_no_bg = background_remover.remove_background(file_path)
+        # Сохраняем изображение
+        file_path, _ = await save_upload_file(file, CATALOG_DIR, BLOCKING_POOL)
         
-        # ВАЖНО: Добавляем белый фон к PNG с прозрачностью (убираем "шахматную доску")
-        from backend.utils.image_utils import add_white_background_to_png
-        file_path_final = add_white_background_to_png(file_path_no_bg)
+        # Удаление фона и белая подложка — одним заходом в пул потоков, event loop не блокируется
+        file_path_final = await run_blocking(_process_catalog_image, file_path)
         
         # Создаем запись в каталоге (относительный путь — чтобы работало на любом сервере)
         item_id = str(uuid.uuid4())
-        filename = Path(file_path_final).name
+        filename = os.path.basename(file_path_final)
         image_path_stored = f"catalog/{filename}"
         catalog_item = {
             "id": item_id,
@@ -628,14 +1075,17 @@ async def add_catalog_item(
             "price": price
         }
         
-        CATALOG_ITEMS.append(catalog_item)
-        save_catalog(CATALOG_ITEMS)  # Сохраняем в файл
+        CATALOG_ITEMS[item_id] = catalog_item
+        CATALOG_FILES[filename] = Path(file_path_final)
+        save_catalog(list(CATALOG_ITEMS.values()))  # Сохраняем в файл
         
         return {
             "success": True,
             "item": catalog_item
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Ошибка добавления в каталог: {str(e)}")
 
@@ -646,16 +1096,7 @@ async def fix_catalog_backgrounds():
     Добавить белый фон ко всем изображениям в каталоге (убрать шахматную доску).
     Вызови один раз после обновления или для старых товаров.
     """
-    from backend.utils.image_utils import add_white_background_to_png
-    
-    fixed = 0
-    for item in CATALOG_ITEMS:
-        path = item.get("image_path")
-        if path:
-            resolved = resolve_furniture_path(path)
-            if Path(resolved).exists():
-                add_white_background_to_png(resolved)
-                fixed += 1
+    fixed = await run_blocking(_fix_catalog_backgrounds_sync)
     
     return {
         "success": True,
@@ -669,10 +1110,8 @@ async def delete_catalog_item(item_id: str):
     """
     Удалить товар из каталога
     """
-    global CATALOG_ITEMS
-    
     # Находим товар
-    item = next((i for i in CATALOG_ITEMS if i['id'] == item_id), None)
+    item = CATALOG_ITEMS.pop(item_id, None)
     
     if not item:
         raise HTTPException(404, "Товар не найден")
@@ -680,12 +1119,11 @@ async def delete_catalog_item(item_id: str):
     # Удаляем файл (путь может быть относительным или с другой машины)
     try:
         Path(resolve_furniture_path(item['image_path'])).unlink(missing_ok=True)
+        CATALOG_FILES.pop(Path(item['image_path']).name, None)
     except Exception as e:
-        print(f"⚠️  Не удалось удалить файл: {e}")
+        logger.warning("⚠️  Не удалось удалить файл: %s", e)
     
-    # Удаляем из каталога
-    CATALOG_ITEMS = [i for i in CATALOG_ITEMS if i['id'] != item_id]
-    save_catalog(CATALOG_ITEMS)  # Сохраняем в файл
+    save_catalog(list(CATALOG_ITEMS.values()))  # Сохраняем в файл
     
     return {
         "success": True,
@@ -698,15 +1136,7 @@ async def health_check():
     """
     Проверка работоспособности API
     """
-    return {
-        "status": "healthy",
-        "services": {
-            "gpt4_vision": "ready",
-            "background_removal": "ready",
-            "inpainting": "ready",
-            "upsell": "ready"
-        }
-    }
+    return HEALTH_STATUS
 
 
 if __name__ == "__main__":
@@ -715,5 +1145,7 @@ if __name__ == "__main__":
         "app:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        reload=True,
+        loop="uvloop",  # uvloop (libuv) вместо стандартного asyncio loop; ставится с uvicorn[standard]
+        http="httptools"  # C-парсер HTTP (тоже из uvicorn[standard])
     )
@@ -2,83 +2,192 @@
 Простая SQLite-база для учёта посетителей и обращений к API.
 Файл БД: data/visits.db
 """
+import atexit
 import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import List, Dict, Any
-from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+from backend.utils.logger import get_logger
+
+logger = get_logger("database")
 
 # Путь к файлу БД (от корня проекта)
 BASE_DIR = Path(__file__).resolve().parent.parent
 DB_PATH = BASE_DIR / "data" / "visits.db"
 
 
+# Настройки соединения: synchronous/cache/mmap действуют только в рамках соединения,
+# journal_mode=WAL сохраняется в самом файле БД (ставится в init_db)
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16384",
+    "PRAGMA busy_timeout=3000",
+    # Страницы транзакции не сбрасываются в БД посреди пачки; автоматический checkpoint — реже,
+    # WAL ограничиваем сами: PASSIVE checkpoint каждые CHECKPOINT_EVERY_BATCHES пачек
+    "PRAGMA cache_spill=OFF",
+    "PRAGMA wal_autocheckpoint=10000",
+)
+CHECKPOINT_EVERY_BATCHES = 20
+
+INSERT_VISIT_SQL = "INSERT INTO visits (ip_address, user_agent, path, method, created_at) VALUES (?, ?, ?, ?, ?)"
+
+# Одно соединение на процесс (открывается в init_db); запросы из разных потоков — под блокировкой
+_CONN: Optional[sqlite3.Connection] = None
+_LOCK = threading.Lock()
+_batches_since_checkpoint = 0
+
+
 def _ensure_data_dir():
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 
-def init_db() -> None:
-    """Создаёт таблицу visits, если её ещё нет."""
-    _ensure_data_dir()
-    conn = sqlite3.connect(DB_PATH)
+def _connect() -> sqlite3.Connection:
+    """
+    Возвращает общее соединение с БД, при первом вызове открывает его и применяет PRAGMA.
+    Autocommit (isolation_level=None): каждый INSERT фиксируется сам, без отдельного commit().
+    """
+    global _CONN
+    if _CONN is None:
+        with _LOCK:
+            if _CONN is None:
+                _ensure_data_dir()
+                conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                for pragma in CONNECTION_PRAGMAS:
+                    conn.execute(pragma)
+                atexit.register(conn.close)
+                _CONN = conn
+    return _CONN
+
+
+# created_at — unix-время в миллисекундах (INTEGER): строка короче ISO-текста, ключи индекса сравниваются как числа.
+# IP не длиннее IPv6 в текстовом виде (45 символов)
+VISITS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ip_address TEXT CHECK(length(ip_address) <= 45),
+        user_agent TEXT,
+        path TEXT,
+        method TEXT,
+        created_at INTEGER
+    )
+"""
+MAX_IP_LENGTH = 45
+
+
+def _migrate_created_at(conn: sqlite3.Connection) -> None:
+    """Переводит старую таблицу (created_at как ISO TEXT) на новую схему, сохраняя визиты."""
+    columns = {row["name"]: row["type"] for row in conn.execute("PRAGMA table_info(visits)")}
+    if columns.get("created_at", "").upper() != "TEXT":
+        return
+    conn.execute("BEGIN")
     try:
+        conn.execute(VISITS_SCHEMA.format(table="visits_new"))
         conn.execute("""
-            CREATE TABLE IF NOT EXISTS visits (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ip_address TEXT,
-                user_agent TEXT,
-                path TEXT,
-                method TEXT,
-                created_at TEXT
-            )
+            INSERT INTO visits_new (id, ip_address, user_agent, path, method, created_at)
+            SELECT id, substr(ip_address, 1, 45), user_agent, path, method,
+                   CAST(ROUND((julianday(created_at) - 2440587.5) * 86400000) AS INTEGER)
+            FROM visits
         """)
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute("DROP TABLE visits")
+        conn.execute("ALTER TABLE visits_new RENAME TO visits")
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    print("🔄 visits.db: created_at переведён в unix-время (мс)")
+
+
+def init_db() -> None:
+    """Создаёт таблицу visits, если её ещё нет, и включает WAL."""
+    conn = _connect()
+    with _LOCK:
+        # Размер страницы 4 КБ (= блок ФС/SSD); на уже созданной БД не меняется — действует до первой записи
+        conn.execute("PRAGMA page_size=4096")
+        # WAL: запись визита — последовательная дозапись в журнал, читатели (админка) не блокируются
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(VISITS_SCHEMA.format(table="visits"))
+        _migrate_created_at(conn)
+        # Для выборок по времени (последние N за период)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_created_at ON visits(created_at DESC)")
+        # Счётчик пробных генераций (get_generate_count) — поиск по индексу, а не проход по всей таблице
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_visits_ip_path ON visits(ip_address, path, method)")
+
+
+def make_visit_row(ip_address: str, user_agent: str, path: str, method: str) -> tuple:
+    """Готовит строку для INSERT визита (время фиксируется в момент обращения, мс с эпохи)."""
+    return (
+        (ip_address or "")[:MAX_IP_LENGTH],
+        (user_agent or "")[:500],
+        path or "",
+        method or "",
+        time.time_ns() // 1_000_000,
+    )
 
 
 def log_visit(ip_address: str, user_agent: str, path: str, method: str) -> None:
     """Пишет один визит в БД."""
-    _ensure_data_dir()
-    conn = sqlite3.connect(DB_PATH)
     try:
-        conn.execute(
-            "INSERT INTO visits (ip_address, user_agent, path, method, created_at) VALUES (?, ?, ?, ?, ?)",
-            (ip_address or "", (user_agent or "")[:500], path or "", method or "", datetime.utcnow().isoformat() + "Z")
-        )
-        conn.commit()
+        conn = _connect()
+        with _LOCK:
+            conn.execute(INSERT_VISIT_SQL, make_visit_row(ip_address, user_agent, path, method))
     except Exception as e:
-        print(f"⚠️  Ошибка записи визита в БД: {e}")
-    finally:
-        conn.close()
+        logger.warning("⚠️  Ошибка записи визита в БД: %s", e)
+
+
+def log_visits(rows: List[tuple]) -> None:
+    """Пишет пачку визитов (строки из make_visit_row) одной транзакцией — одна фиксация на всю пачку."""
+    global _batches_since_checkpoint
+    if not rows:
+        return
+    try:
+        conn = _connect()
+        with _LOCK:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(INSERT_VISIT_SQL, rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            _batches_since_checkpoint += 1
+            if _batches_since_checkpoint >= CHECKPOINT_EVERY_BATCHES:
+                # PASSIVE не ждёт читателей — переносит в БД то, что можно, и не блокирует админку
+                conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+                _batches_since_checkpoint = 0
+    except Exception as e:
+        logger.warning("⚠️  Ошибка записи визитов в БД: %s", e)
 
 
 def get_generate_count(ip_address: str) -> int:
     """Сколько раз этот IP уже вызывал POST /api/generate (для лимита пробных запросов)."""
     if not ip_address or not DB_PATH.exists():
         return 0
-    conn = sqlite3.connect(DB_PATH)
-    try:
+    conn = _connect()
+    with _LOCK:
         cur = conn.execute(
             "SELECT COUNT(*) FROM visits WHERE ip_address = ? AND path = '/api/generate' AND method = 'POST'",
             (ip_address.strip(),)
         )
         return cur.fetchone()[0] or 0
-    finally:
-        conn.close()
 
 
 def get_visits(limit: int = 500) -> List[Dict[str, Any]]:
     """Возвращает последние визиты (новые сверху)."""
     if not DB_PATH.exists():
         return []
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
+    conn = _connect()
+    with _LOCK:
         cur = conn.execute(
-            "SELECT id, ip_address, user_agent, path, method, created_at FROM visits ORDER BY id DESC LIMIT ?",
+            # created_at отдаём в прежнем ISO-виде — админка показывает его как есть
+            "SELECT id, ip_address, user_agent, path, method, "
+            "strftime('%Y-%m-%dT%H:%M:%fZ', created_at / 1000.0, 'unixepoch') AS created_at "
+            "FROM visits ORDER BY id DESC LIMIT ?",
             (limit,)
         )
         rows = cur.fetchall()
-        return [dict(r) for r in rows]
-    finally:
-        conn.close()
+    return [dict(r) for r in rows]
@@ -1,14 +1,17 @@
 """
-Pydantic модели для API
+Pydantic модели для API.
+Внутренние структуры (не проходят через HTTP) — dataclass без валидации при создании.
 """
+from dataclasses import dataclass
 from typing import Optional, List, Dict, Any
 from pydantic import BaseModel, Field
 
 
-class PlacementMode(BaseModel):
+@dataclass(slots=True, frozen=True)
+class PlacementMode:
     """Режим размещения мебели"""
-    mode: str = Field(..., description="auto или manual")
-    position: Optional[Dict[str, int]] = Field(None, description="Позиция для manual режима {x, y}")
+    mode: str  # auto или manual
+    position: Optional[Dict[str, int]] = None  # Позиция для manual режима {x, y}
 
 
 class AnalyzeRequest(BaseModel):
@@ -49,12 +52,13 @@ class UpsellRequest(BaseModel):
     catalog_items: List[Dict[str, Any]] = Field(..., description="Каталог доступной мебели")
 
 
-class UpsellItem(BaseModel):
-    """Рекомендуемый товар"""
-    item_id: str = Field(..., description="ID товара")
-    name: str = Field(..., description="Название")
-    reason: str = Field(..., description="Почему рекомендуем")
-    image_url: Optional[str] = Field(None, description="URL изображения")
+@dataclass(slots=True, frozen=True)
+class UpsellItem:
+    """Рекомендуемый товар (в UpsellResponse Pydantic валидирует dataclass-поля как обычно)"""
+    item_id: str  # ID товара
+    name: str  # Название
+    reason: str  # Почему рекомендуем
+    image_url: Optional[str] = None  # URL изображения
 
 
 class UpsellResponse(BaseModel):
@@ -62,15 +66,16 @@ class UpsellResponse(BaseModel):
     recommendations: List[UpsellItem] = Field(..., description="Список рекомендаций")
 
 
-class CatalogItem(BaseModel):
+@dataclass(slots=True, frozen=True)
+class CatalogItem:
     """Элемент каталога мебели"""
-    id: str = Field(..., description="ID товара")
-    name: str = Field(..., description="Название")
-    type: str = Field(..., description="Тип мебели (диван, кресло, стол и тд)")
-    style: str = Field(..., description="Стиль (современный, классический и тд)")
-    image_path: str = Field(..., description="Путь к изображению")
-    description: Optional[str] = Field(None, description="Описание")
-    price: Optional[float] = Field(None, description="Цена")
+    id: str  # ID товара
+    name: str  # Название
+    type: str  # Тип мебели (диван, кресло, стол и тд)
+    style: str  # Стиль (современный, классический и тд)
+    image_path: str  # Путь к изображению
+    description: Optional[str] = None  # Описание
+    price: Optional[float] = None  # Цена
 
 
 class ErrorResponse(BaseModel):
@@ -1,19 +1,119 @@
 """
 Сервис для удаления фона с изображений мебели
 """
+import importlib.util
+import mmap
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
-from PIL import Image
-import io
-
-# Используем rembg (встроенная библиотека)
-try:
-    from rembg import remove
-    REMBG_AVAILABLE = True
-except ImportError:
-    REMBG_AVAILABLE = False
+from typing import Optional, List
+from PIL import Image, ImageOps
+
+# Используем rembg (встроенная библиотека). Импорт тянет onnxruntime (~0.5 с) —
+# при старте только проверяем, что пакет есть, а импортируем при первом удалении фона
+REMBG_AVAILABLE = importlib.util.find_spec("rembg") is not None
+if not REMBG_AVAILABLE:
     print("⚠️  rembg не установлен. Удаление фона будет пропущено.")
 
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+
+# INT8-версия U²-Net (static QDQ квантизация, см. quantize_u2net_int8).
+# Быстрее FP32 только на CPU с AVX-512 VNNI — на остальных INT8 медленнее, там используем FP32.
+REMBG_INT8_MODEL = Path(os.getenv("REMBG_INT8_MODEL") or BASE_DIR / "data" / "models" / "u2net_int8.onnx")
+
+# Модель rembg по умолчанию; переопределяется REMBG_MODEL: u2netp (меньше и быстрее), isnet-general-use и др.
+DEFAULT_REMBG_MODEL = "u2net"
+
+# Порядок предпочтения ONNX Runtime: GPU (CUDA / CoreML на Mac / DirectML на Windows), затем CPU
+REMBG_PROVIDER_PREFERENCE = (
+    "CUDAExecutionProvider",
+    "CoreMLExecutionProvider",
+    "DmlExecutionProvider",
+    "CPUExecutionProvider",
+)
+
+# Вырезка — промежуточный файл (каталог сразу перезаписывает её с белым фоном):
+# zlib уровня 1 кодирует PNG в разы быстрее уровня 6 ценой файла на 10–20% больше
+CUTOUT_PNG_COMPRESS_LEVEL = 1
+
+# Верхняя граница ответа Remove.bg (по Content-Length) — защита от неожиданно огромного файла
+REMOVEBG_MAX_RESULT_BYTES = 50 * 1024 * 1024
+
+U2NET_INPUT_SIZE = (320, 320)
+U2NET_MEAN = (0.485, 0.456, 0.406)
+U2NET_STD = (0.229, 0.224, 0.225)
+
+
+def _cpu_has_vnni() -> bool:
+    """Есть ли у CPU инструкции AVX-512 VNNI (INT8 GEMM)."""
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "avx512_vnni" in f.read()
+    except OSError:
+        return False
+
+
+CPU_HAS_VNNI = _cpu_has_vnni()
+
+
+def _rembg_providers() -> List[str]:
+    """Провайдеры ONNX Runtime из REMBG_PROVIDER_PREFERENCE, которые есть в установленной сборке."""
+    import onnxruntime as ort
+    available = set(ort.get_available_providers())
+    return [p for p in REMBG_PROVIDER_PREFERENCE if p in available] or ["CPUExecutionProvider"]
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_has_transparency(path: str) -> Optional[bool]:
+    """
+    Прозрачность PNG по заголовку, без декодирования (None — не PNG, решает PIL).
+    Тип цвета в IHDR (байт 25): 4 — LA, 6 — RGBA; 3 — палитра, прозрачна при наличии чанка tRNS до IDAT.
+    Как и проверка через PIL, tRNS у RGB/L без альфа-канала прозрачностью не считаем.
+    """
+    with open(path, "rb") as f:
+        header = f.read(33)
+        if len(header) < 33 or not header.startswith(PNG_SIGNATURE) or header[12:16] != b"IHDR":
+            return None
+        color_type = header[25]
+        if color_type in (4, 6):
+            return True
+        if color_type != 3:
+            return False
+        # Проходим по заголовкам чанков (длина + тип), данные пропускаем seek-ом
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return False
+            length = int.from_bytes(chunk[:4], "big")
+            chunk_type = chunk[4:8]
+            if chunk_type == b"tRNS":
+                return True
+            if chunk_type in (b"IDAT", b"IEND"):
+                return False
+            f.seek(length + 4, os.SEEK_CUR)  # данные + CRC
+
+
+def _open_for_rembg(path: str) -> Image.Image:
+    """
+    Открывает фото с учётом EXIF-поворота (как rembg.remove).
+    Файл отображается в память (mmap): декодер читает страницы кэша ОС напрямую, без копий в буферы Python.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with Image.open(mm) as img:
+            return ImageOps.exif_transpose(img).convert("RGBA")
+
+
+def _u2net_input(img: Image.Image):
+    """Готовит изображение к входу U²-Net так же, как rembg: 320x320, нормализация ImageNet, NCHW float32."""
+    import numpy as np
+    im = np.array(img.convert("RGB").resize(U2NET_INPUT_SIZE, Image.Resampling.LANCZOS), dtype=np.float32)
+    im = im / max(float(np.max(im)), 1e-6)
+    im = (im - np.array(U2NET_MEAN, dtype=np.float32)) / np.array(U2NET_STD, dtype=np.float32)
+    return np.expand_dims(im.transpose((2, 0, 1)), 0).astype(np.float32)
+
 
 class BackgroundRemover:
     """
@@ -28,8 +128,12 @@ class BackgroundRemover:
         
         Args:
             use_api: Использовать Remove.bg API (требует API ключ)
+        
+        Модель rembg выбирается переменной окружения REMBG_MODEL (по умолчанию u2net).
         """
         self.use_api = use_api
+        self._session = None
+        self._http = None  # requests.Session для Remove.bg, создаётся при первом запросе
         
         if use_api:
             from ..utils.load_env import get_env_variable
@@ -56,11 +160,120 @@ class BackgroundRemover:
         if output_path is None:
             output_path = input_path
         
+        # Фон уже удалён (есть альфа-канал) — нейросеть/API не запускаем
+        if self.check_has_transparency(input_path):
+            return self._keep_transparent(input_path, output_path)
+        
         if self.use_api:
             return self._remove_with_api(input_path, output_path)
         else:
             return self._remove_with_rembg(input_path, output_path)
     
+    def remove_background_batch(
+        self,
+        input_paths: List[str],
+        output_paths: Optional[List[str]] = None
+    ) -> List[str]:
+        """
+        Удаляет фон у нескольких изображений одним прогоном U²-Net (батч N×3×320×320).
+        Декодирование, подготовка входа и запись PNG идут в пуле потоков.
+        Remove.bg, модели не из семейства U²-Net и модели без динамического батча — по одному.
+        
+        Args:
+            input_paths: Пути к входным изображениям
+            output_paths: Пути для сохранения (если None, перезаписываем)
+            
+        Returns:
+            Пути к изображениям без фона (в том же порядке)
+        """
+        if output_paths is None:
+            output_paths = list(input_paths)
+        
+        # Уже прозрачные изображения в батч не попадают (см. remove_background)
+        opaque = [k for k, p in enumerate(input_paths) if not self.check_has_transparency(p)]
+        if len(opaque) < len(input_paths):
+            opaque_set = set(opaque)
+            results = [
+                None if k in opaque_set else self._keep_transparent(i, o)
+                for k, (i, o) in enumerate(zip(input_paths, output_paths))
+            ]
+            if opaque:
+                done = self.remove_background_batch(
+                    [input_paths[k] for k in opaque],
+                    [output_paths[k] for k in opaque]
+                )
+                for k, path in zip(opaque, done):
+                    results[k] = path
+            return results
+        
+        def one_by_one() -> List[str]:
+            return [self.remove_background(i, o) for i, o in zip(input_paths, output_paths)]
+        
+        if self.use_api or not REMBG_AVAILABLE or len(input_paths) < 2:
+            return one_by_one()
+        try:
+            session = self._get_session()
+        except ImportError as e:
+            print(f"⚠️  rembg не загружается ({e}), удаляем фон по одному")
+            return one_by_one()
+        if not getattr(session, "model_name", "").startswith("u2net"):
+            return one_by_one()
+        
+        import numpy as np
+        with ThreadPoolExecutor(max_workers=min(8, len(input_paths))) as pool:
+            images = list(pool.map(_open_for_rembg, input_paths))
+            batch = np.concatenate(list(pool.map(_u2net_input, images)))
+            try:
+                inner = session.inner_session
+                preds = inner.run(None, {inner.get_inputs()[0].name: batch})[0][:, 0, :, :]
+            except Exception as e:
+                print(f"⚠️  Модель не принимает батч ({e}), удаляем фон по одному")
+                return one_by_one()
+            return list(pool.map(self._save_cutout, images, preds, input_paths, output_paths))
+    
+    def _keep_transparent(self, input_path: str, output_path: str) -> str:
+        """
+        Изображение уже с прозрачностью: копия вместо удаления фона.
+        Не жёсткая ссылка — результат потом перезаписывается на месте (белый фон) и затёр бы исходник.
+        """
+        if input_path != output_path:
+            shutil.copy(input_path, output_path)
+        print(f"✅ Уже есть прозрачность, удаление фона не нужно: {output_path}")
+        return output_path
+    
+    def _save_cutout(self, img: Image.Image, pred, input_path: str, output_path: str) -> str:
+        """Маска U²-Net -> вырезка (как rembg: нормализация, LANCZOS до размера фото, naive cutout) и запись."""
+        import numpy as np
+        mi, ma = float(pred.min()), float(pred.max())
+        pred = (pred - mi) / max(ma - mi, 1e-6)
+        mask = Image.fromarray((pred * 255).astype(np.uint8), mode="L").resize(img.size, Image.Resampling.LANCZOS)
+        cutout = Image.composite(img, Image.new("RGBA", img.size, 0), mask)
+        if self._is_result_mostly_empty(cutout):
+            print(f"⚠️  Результат удаления фона почти пустой, используем оригинал: {input_path}")
+            return input_path
+        cutout.save(output_path, 'PNG', compress_level=CUTOUT_PNG_COMPRESS_LEVEL)
+        print(f"✅ Фон удален (rembg, батч): {output_path}")
+        return output_path
+    
+    def _get_session(self):
+        """
+        Сессия rembg создаётся один раз и переиспользуется.
+        Если есть GPU-провайдер (CUDA/CoreML/DirectML) — модель запускается на нём.
+        На CPU с AVX-512 VNNI для u2net берём INT8-модель (если она собрана), иначе — обычную FP32.
+        """
+        if self._session is None:
+            from rembg import new_session
+            model_name = os.getenv("REMBG_MODEL") or DEFAULT_REMBG_MODEL
+            providers = _rembg_providers()
+            on_cpu = providers[0] == "CPUExecutionProvider"
+            if on_cpu and model_name == "u2net" and CPU_HAS_VNNI and REMBG_INT8_MODEL.exists():
+                print(f"⚡ rembg: INT8 U²-Net ({REMBG_INT8_MODEL.name}), CPU с VNNI")
+                self._session = new_session("u2net_custom", providers=providers, model_path=str(REMBG_INT8_MODEL))
+            else:
+                print(f"🧠 rembg: {model_name} ({providers[0]})")
+                self._session = new_session(model_name, providers=providers)
+        return self._session
+    
     def _remove_with_rembg(self, input_path: str, output_path: str) -> str:
         """
         Удаляет фон используя rembg (локально, бесплатно)
@@ -76,33 +289,19 @@ class BackgroundRemover:
         if not REMBG_AVAILABLE:
             print(f"⚠️  rembg не установлен, пропускаем удаление фона")
             if input_path != output_path:
-                import shutil
                 shutil.copy(input_path, output_path)
             return output_path
         
         try:
-            with open(input_path, 'rb') as input_file:
-                input_data = input_file.read()
-            
-            output_data = remove(input_data)
-            output_image = Image.open(io.BytesIO(output_data))
-            # Сохраняем во временный файл, чтобы не затирать оригинал
-            import tempfile
-            fd, temp_path = tempfile.mkstemp(suffix='.png')
-            try:
-                output_image.save(temp_path, 'PNG')
-                if self._is_result_mostly_empty(temp_path):
-                    print(f"⚠️  Результат удаления фона почти пустой, используем оригинал: {input_path}")
-                    return input_path
-                import shutil
-                shutil.copy(temp_path, output_path)
-            finally:
-                import os
-                try:
-                    os.close(fd)
-                    os.unlink(temp_path)
-                except Exception:
-                    pass
+            from rembg import remove
+            # PIL-изображение на входе — rembg возвращает PIL-изображение (без PNG-кодирования в bytes и обратно)
+            with Image.open(input_path) as input_image:
+                output_image = remove(input_image, session=self._get_session())
+            # Пустой результат проверяем в памяти — оригинал не затирается, временный файл не нужен
+            if self._is_result_mostly_empty(output_image):
+                print(f"⚠️  Результат удаления фона почти пустой, используем оригинал: {input_path}")
+                return input_path
+            output_image.save(output_path, 'PNG', compress_level=CUTOUT_PNG_COMPRESS_LEVEL)
             
             print(f"✅ Фон удален (rembg): {output_path}")
             return output_path
@@ -111,14 +310,12 @@ class BackgroundRemover:
             print(f"❌ Ошибка удаления фона (rembg): {e}")
             # В случае ошибки возвращаем оригинал
             if input_path != output_path:
-                import shutil
                 shutil.copy(input_path, output_path)
             return output_path
     
-    def _is_result_mostly_empty(self, image_path: str, min_visible_ratio: float = 0.02) -> bool:
+    def _is_result_mostly_empty(self, img: Image.Image, min_visible_ratio: float = 0.02) -> bool:
         """Проверяет, что после удаления фона осталось слишком мало объекта (пустой результат)."""
         try:
-            img = Image.open(image_path)
             img = img.convert("RGBA")
             w, h = img.size
             total = w * h
@@ -147,30 +344,39 @@ class BackgroundRemover:
             Путь к результату
         """
         try:
-            import requests
+            if self._http is None:
+                from ..utils.http_session import create_session
+                self._http = create_session({'X-Api-Key': self.api_key})
             
-            # Отправляем запрос к Remove.bg API
+            # Отправляем запрос к Remove.bg API; ответ пишем на диск потоком, не держа весь PNG в памяти
             with open(input_path, 'rb') as input_file:
-                response = requests.post(
+                response = self._http.post(
                     'https://api.remove.bg/v1.0/removebg',
                     files={'image_file': input_file},
                     data={'size': 'auto'},
-                    headers={'X-Api-Key': self.api_key},
-                    timeout=30
+                    timeout=30,
+                    stream=True
                 )
             
-            if response.status_code == 200:
-                # Сохраняем результат
-                with open(output_path, 'wb') as output_file:
-                    output_file.write(response.content)
-                
-                print(f"✅ Фон удален (Remove.bg API): {output_path}")
-                return output_path
-            else:
-                print(f"⚠️  Remove.bg API ошибка: {response.status_code}")
-                print(f"Ответ: {response.text}")
-                # Откатываемся на rembg
-                return self._remove_with_rembg(input_path, output_path)
+            with response:
+                if response.status_code == 200:
+                    content_length = int(response.headers.get('Content-Length') or 0)
+                    if content_length > REMOVEBG_MAX_RESULT_BYTES:
+                        raise ValueError(f"слишком большой ответ Remove.bg: {content_length} байт")
+                    
+                    # Сохраняем результат
+                    with open(output_path, 'wb') as output_file:
+                        for chunk in response.iter_content(chunk_size=1 << 20):
+                            output_file.write(chunk)
+                    
+                    print(f"✅ Фон удален (Remove.bg API): {output_path}")
+                    return output_path
+                else:
+                    print(f"⚠️  Remove.bg API ошибка: {response.status_code}")
+                    print(f"Ответ: {response.text}")
+            
+            # Откатываемся на rembg
+            return self._remove_with_rembg(input_path, output_path)
             
         except Exception as e:
             print(f"❌ Ошибка Remove.bg API: {e}")
@@ -188,9 +394,64 @@ class BackgroundRemover:
             True если есть альфа-канал
         """
         try:
+            # PNG: ответ есть в заголовках чанков, IDAT не читаем и не распаковываем
+            has_alpha = _png_has_transparency(image_path)
+            if has_alpha is not None:
+                return has_alpha
             image = Image.open(image_path)
             return image.mode in ('RGBA', 'LA') or (
                 image.mode == 'P' and 'transparency' in image.info
             )
         except Exception:
             return False
+
+def quantize_u2net_int8(
+    calibration_dir: Path = BASE_DIR / "data" / "catalog",
+    output_path: Path = REMBG_INT8_MODEL,
+    max_images: int = 32
+) -> Path:
+    """
+    Собирает INT8-версию U²-Net статической квантизацией (QDQ, per-channel, симметричная).
+    Калибровка — на реальных фото мебели из каталога.
+    Запуск один раз: python -m backend.services.background_remover
+    """
+    from onnxruntime import InferenceSession
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+    from rembg.sessions.u2net import U2netSession
+
+    fp32_path = U2netSession.download_models()
+    input_name = InferenceSession(fp32_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    image_paths: List[Path] = sorted(
+        p for p in Path(calibration_dir).iterdir()
+        if p.suffix.lower() in (".png", ".jpg", ".jpeg", ".webp")
+    )[:max_images]
+    if not image_paths:
+        raise ValueError(f"Нет изображений для калибровки в {calibration_dir}")
+
+    class _CatalogCalibrationReader(CalibrationDataReader):
+        def __init__(self):
+            self._inputs = ({input_name: _u2net_input(Image.open(p))} for p in image_paths)
+
+        def get_next(self):
+            return next(self._inputs, None)
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    quantize_static(
+        fp32_path,
+        str(output_path),
+        calibration_data_reader=_CatalogCalibrationReader(),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QInt8,
+        weight_type=QuantType.QInt8,
+        extra_options={"ActivationSymmetric": True, "WeightSymmetric": True}
+    )
+    print(f"✅ INT8 U²-Net сохранена: {output_path} (калибровка на {len(image_paths)} изображениях)")
+    return output_path
+
+
+if __name__ == "__main__":
+    if not CPU_HAS_VNNI:
+        print("⚠️  CPU без AVX-512 VNNI: INT8-модель будет собрана, но использоваться не будет")
+    quantize_u2net_int8()
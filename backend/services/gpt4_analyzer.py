@@ -1,15 +1,222 @@
 """
 Сервис для анализа изображений с помощью Gemini 2.5 Pro через Kie.ai
 """
-import json
+import copy
+import gzip
+import hashlib
+import os
+import re
+import threading
 import time
-import requests
-from typing import Dict, Any, Optional, Tuple, List
-from ..utils.load_env import get_env_variable
+import orjson
+from collections import OrderedDict
+from pathlib import Path
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple, List, Mapping
+from ..utils.load_env import get_env_variable, get_env_optional
+from ..utils.http_session import get_shared_session, backoff_delay
 from .image_uploader import ImageUploader
 
 KIE_RETRY_COUNT = 3
-KIE_RETRY_DELAY = 15
+# Повтор при maintenance: 5–7.5 сек, затем 10–15 сек (экспонента с джиттером, см. backoff_delay)
+KIE_RETRY_BASE_DELAY = 5
+KIE_RETRY_MAX_DELAY = 30
+
+# Уровень gzip для тела запроса: 3 — почти весь выигрыш по размеру за малую долю CPU уровня 9
+GZIP_REQUEST_LEVEL = 3
+
+# Подготовка изображений (чтение, уменьшение, JPEG, base64) независима для каждого файла —
+# делаем параллельно; 6 потоков = комната + максимум 5 предметов мебели в одном запросе
+PREPARE_WORKERS = 6
+_prepare_pool = ThreadPoolExecutor(max_workers=PREPARE_WORKERS, thread_name_prefix="gemini-prepare")
+
+# Содержимое первого markdown-блока ```json ... ``` (или ``` ... ```) — один проход вместо серии find()
+_FENCED_JSON_RE = re.compile(r"```(?:json)?(.*?)```", re.DOTALL)
+
+# Промпты одиночного размещения не зависят от запроса — собираем один раз при импорте
+_AUTO_PLACEMENT_SYSTEM = """Ты эксперт по интерьерному дизайну и 3D-композиции.
+Твоя задача - проанализировать фото комнаты и мебели, определить ЛУЧШЕЕ место для размещения мебели.
+
+КРИТИЧЕСКИ ВАЖНО: 
+- Комната и мебель должны остаться ПОЛНОСТЬЮ неизменными!
+- Описывай мебель МАКСИМАЛЬНО точно и детально
+- Укажи ТОЧНЫЙ цвет, ТОЧНУЮ форму, ТОЧНЫЕ детали
+- Ты определяешь только область куда вставить мебель БЕЗ изменения её внешнего вида
+- Учитывай перспективу, освещение, пропорции
+
+Верни ответ СТРОГО в JSON формате."""
+
+_AUTO_PLACEMENT_USER = """Проанализируй эти изображения:
+1. Первое изображение - комната
+2. Второе изображение - мебель
+
+Определи:
+1. Характеристики комнаты (размер, освещение, стиль, перспектива)
+2. Характеристики мебели - БУДЬ МАКСИМАЛЬНО ТОЧНЫМ В ОПИСАНИИ!
+3. ЛУЧШЕЕ место для размещения мебели
+
+Верни JSON:
+{
+  "room_analysis": {
+    "size_estimate": "примерный размер в метрах",
+    "lighting": "описание освещения",
+    "style": "стиль интерьера",
+    "perspective": "описание перспективы камеры",
+    "free_spaces": ["список свободных мест"]
+  },
+  "furniture_analysis": {
+    "type": "тип мебели (диван, кресло, стол...)",
+    "estimated_size": "примерный размер в метрах",
+    "style": "детальное описание стиля",
+    "color": "ТОЧНЫЙ цвет с оттенком (например: 'deep purple', 'burgundy', 'dark violet')",
+    "features": ["детальные особенности: форма подлокотников, тип обивки, наличие подушек, форма ножек и т.д."]
+  },
+  "placement": {
+    "x_percent": 50,
+    "y_percent": 60,
+    "width_percent": 35,
+    "height_percent": 25,
+    "scale": 0.85,
+    "rotation": 15,
+    "reasoning": "почему это лучшее место"
+  },
+  "inpainting_prompt": "НЕ используется - оставь пустым"
+}
+
+ВАЖНО: 
+- Опиши цвет мебели МАКСИМАЛЬНО точно
+- Опиши все визуальные детали мебели
+- Укажи материал и текстуру если видно
+
+Координаты в процентах от размера изображения."""
+
+_AUTO_PLACEMENT_PROMPT: Mapping[str, str] = MappingProxyType({
+    "system": _AUTO_PLACEMENT_SYSTEM,
+    "user": _AUTO_PLACEMENT_USER
+})
+
+_MANUAL_PLACEMENT_SYSTEM = """Ты эксперт по интерьерному дизайну.
+Пользователь указал конкретное место где хочет разместить мебель.
+Твоя задача - определить правильный размер и параметры для этого места.
+
+ВАЖНО: НЕ меняй детали комнаты!"""
+
+_MANUAL_PLACEMENT_USER_TEMPLATE = """Пользователь хочет разместить мебель в позиции ({x}, {y}).
+
+Проанализируй:
+1. Подходит ли это место для данной мебели
+2. Какой размер должна иметь мебель в этом месте
+3. Под каким углом её разместить
+
+Изображения:
+1. Первое - комната
+2. Второе - мебель
+
+Верни JSON как в предыдущем примере, но используй указанную позицию."""
+
+# Промпты нескольких предметов: шаблоны str.format, подставляется только число предметов и позиция
+_MULTI_AUTO_SYSTEM_TEMPLATE = """Ты эксперт по интерьерному дизайну и 3D-композиции.
+Твоя задача - проанализировать фото комнаты и {furniture_count} предметов мебели, определить ЛУЧШЕЕ размещение для КАЖДОГО предмета так, чтобы они гармонично сочетались.
+
+КРИТИЧЕСКИ ВАЖНО:
+- Все предметы должны остаться ПОЛНОСТЬЮ неизменными!
+- Опис
+
+ывай каждый предмет МАКСИМАЛЬНО точно и детально
+- Укажи ТОЧНЫЙ цвет, ТОЧНУЮ форму, ТОЧНЫЕ детали каждого
+- Размещай предметы так, чтобы они не перекрывали друг друга
+- Учитывай перспективу, освещение, пропорции
+
+Верни ответ СТРОГО в JSON формате."""
+
+_MULTI_AUTO_USER_TEMPLATE = """Проанализируй эти изображения:
+1. Первое изображение - комната
+2. Следующие {furniture_count} изображений - предметы мебели
+
+Определи для КАЖДОГО предмета:
+1. Характеристики (тип, размер, цвет, стиль)
+2. ЛУЧШЕЕ место для размещения
+3. Как предметы сочетаются между собой
+
+Верни JSON:
+{{
+  "room_analysis": {{
+    "size_estimate": "примерный размер в метрах",
+    "lighting": "описание освещения",
+    "style": "стиль интерьера",
+    "perspective": "описание перспективы камеры",
+    "free_spaces": ["список свободных мест"]
+  }},
+  "furniture_items": [
+    {{
+      "index": 0,
+      "type": "тип мебели",
+      "estimated_size": "размер",
+      "style": "стиль",
+      "color": "ТОЧНЫЙ цвет",
+      "features": ["особенности"],
+      "placement": {{
+        "x_percent": 50,
+        "y_percent": 60,
+        "width_percent": 35,
+        "height_percent": 25,
+        "scale": 0.85,
+        "rotation": 15,
+        "reasoning": "почему это место"
+      }}
+    }}
+  ],
+  "overall_composition": "как предметы сочетаются между собой"
+}}
+
+Координаты в процентах от размера изображения."""
+
+_MULTI_MANUAL_SYSTEM_TEMPLATE = """Ты эксперт по интерьерному дизайну.
+Пользователь указал место где хочет разместить {furniture_count} предметов мебели.
+Определи размеры и параметры для каждого предмета."""
+
+_MULTI_MANUAL_USER_TEMPLATE = """Пользователь выбрал позицию ({x}, {y}) для размещения {furniture_count} предметов.
+
+Проанализируй все предметы и определи их оптимальное размещение в этой области.
+
+Изображения:
+1. Первое - комната
+2. Следующие {furniture_count} - предметы мебели
+
+Верни JSON в том же формате что и для автоматического размещения."""
+
+# Промпт режима «Заменить мебель» (analyze_room_for_replace) — статичный
+_REPLACE_ROOM_PROMPT = """Look at this room interior photo. List ONLY the furniture that you CLEARLY SEE in the image. Do NOT invent or assume anything that is not visible (e.g. if there is no bed, do not list a bed).
+For each item that is actually visible provide: "type" (one word in English: sofa, table, bed, chair, desk, cabinet, armchair, etc.) and "position" (left / center / right).
+CRITICAL: Include only items that are unambiguously present in the photo. If in doubt, omit the item.
+Return ONLY a valid JSON object, no markdown, no code block. Example:
+{"items": [{"type": "table", "position": "center"}, {"type": "chair", "position": "right"}]}
+If you see no clear furniture, return {"items": []}."""
+
+# Кэш анализов по содержимому файлов: повторная загрузка тех же фото (новый путь в uploads/)
+# не вызывает Gemini заново. Ответ Gemini — 5–30 сек и платный, sha256 файла — миллисекунды.
+ANALYSIS_CACHE_SIZE = 128
+
+
+# Списки мебели для «Заменить мебель» — на диске: переживают перезапуск сервера.
+# Ключ — blake2b от подготовленного (уменьшенного JPEG) изображения: тот же снимок под другим именем — тот же ключ
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+REPLACE_CACHE_DIR = BASE_DIR / "data" / "cache" / "replace_analysis"
+# Сколько списков хранить (REPLACE_CACHE_SIZE в .env); сверх лимита удаляются давно не использованные
+REPLACE_CACHE_SIZE = 500
+
+
+def _replace_cache_path(room_url: str) -> Path:
+    """Файл кэша для data URL комнаты (blake2b — быстрее sha256, криптостойкость здесь не нужна)."""
+    key = hashlib.blake2b(room_url.encode('ascii'), digest_size=16).hexdigest()
+    return REPLACE_CACHE_DIR / f"{key}.json"
+
+
+def _file_sha256(path: str) -> str:
+    """sha256 содержимого файла (hashlib использует аппаратные SHA-инструкции, если они есть)."""
+    with open(path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
 
 
 class GPT4Analyzer:
@@ -22,6 +229,115 @@ class GPT4Analyzer:
         self.api_key = get_env_variable('KIE_AI_API_KEY')
         self.api_url = "https://api.kie.ai/gemini-2.5-pro/v1/chat/completions"
         self.uploader = ImageUploader()
+        # Общая на процесс сессия: keep-alive к api.kie.ai не зависит от числа экземпляров анализатора
+        self._http = get_shared_session()
+        # Тело запроса сериализуем orjson (мегабайтные base64-строки) и шлём как data= — Content-Type задаём сами
+        self._headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        # KIE_GZIP_REQUESTS=true — сжимать тело запроса (base64 сжимается на ~25%). По умолчанию выключено:
+        # поддержка Content-Encoding в запросах у Kie.ai не задокументирована. Ответы requests и так просит в gzip.
+        self._gzip_requests = get_env_optional("KIE_GZIP_REQUESTS").strip().lower() in ("1", "true", "yes")
+        if self._gzip_requests:
+            self._headers["Content-Encoding"] = "gzip"
+        self._analysis_cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.replace_cache_size = int(get_env_optional('REPLACE_CACHE_SIZE') or REPLACE_CACHE_SIZE)
+    
+    def _request_body(self, payload: Dict[str, Any]) -> bytes:
+        """JSON-тело запроса к Kie.ai (orjson), при KIE_GZIP_REQUESTS — сжатое gzip."""
+        body = orjson.dumps(payload)
+        if self._gzip_requests:
+            body = gzip.compress(body, compresslevel=GZIP_REQUEST_LEVEL)
+        return body
+    
+    def _kie_call(self, payload: Dict[str, Any], timeout: int) -> Dict[str, Any]:
+        """
+        POST к Kie.ai с повтором при maintenance (экспонента с джиттером), ответ — разобранный JSON.
+        422 (Kie.ai не принял изображения), прочие HTTP-ошибки и не-JSON ответ — исключение.
+        """
+        body = self._request_body(payload)  # сериализуем один раз на все попытки
+        for attempt in range(KIE_RETRY_COUNT):
+            response = self._http.post(self.api_url, headers=self._headers, data=body, timeout=timeout)
+            try:
+                result = orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                response.raise_for_status()
+                raise ValueError(f"Kie.ai вернул не JSON (HTTP {response.status_code})")
+            # 422 = Kie.ai не смог получить файл (при ссылках). Мы шлём base64 — 422 не должно быть.
+            if response.status_code == 422 or (result.get("code") == 422 and "file" in (result.get("msg") or "").lower()):
+                raise ValueError(f"Gemini отклонил изображения: {result.get('msg', '')}")
+            response.raise_for_status()
+            
+            if result.get("code") == 500 and "maintained" in (result.get("msg") or "").lower():
+                if attempt < KIE_RETRY_COUNT - 1:
+                    delay = backoff_delay(attempt, KIE_RETRY_BASE_DELAY, KIE_RETRY_MAX_DELAY)
+                    print(f"⏳ Kie.ai на обслуживании, повтор через {delay:.1f} сек... ({attempt + 1}/{KIE_RETRY_COUNT})")
+                    time.sleep(delay)
+                    continue
+                raise ValueError("Kie.ai временно недоступен (maintenance). Попробуйте позже.")
+            return result
+    
+    def _cache_key(self, kind: str, image_paths: List[str], manual_position: Optional[Tuple[int, int]]) -> Optional[tuple]:
+        """Ключ кэша: режим + хэши содержимого всех изображений (в порядке) + ручная позиция."""
+        try:
+            digests = tuple(_file_sha256(p) for p in image_paths)
+        except OSError:
+            return None
+        return (kind, digests, tuple(manual_position) if manual_position else None)
+    
+    def _cache_get(self, key: Optional[tuple]) -> Optional[Dict[str, Any]]:
+        if key is None:
+            return None
+        with self._cache_lock:
+            analysis = self._analysis_cache.get(key)
+            if analysis is None:
+                return None
+            self._analysis_cache.move_to_end(key)
+        print(f"♻️  Анализ Gemini взят из кэша")
+        return copy.deepcopy(analysis)
+    
+    def _cache_put(self, key: Optional[tuple], analysis: Dict[str, Any]) -> None:
+        # Запасной ответ при неразобранном JSON не кэшируем — следующий запрос снова спросит Gemini
+        if key is None or analysis.get("placement", {}).get("reasoning") == "Default placement":
+            return
+        with self._cache_lock:
+            self._analysis_cache[key] = copy.deepcopy(analysis)
+            self._analysis_cache.move_to_end(key)
+            while len(self._analysis_cache) > ANALYSIS_CACHE_SIZE:
+                self._analysis_cache.popitem(last=False)
+    
+    def _replace_cache_put(self, cache_path: Path, analysis: Dict[str, Any]) -> None:
+        """
+        Сохраняет разобранный ответ на диск (через временный файл — читатель не увидит недописанный JSON)
+        и удаляет давно не использованные записи сверх лимита.
+        """
+        if self.replace_cache_size <= 0:
+            return
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(orjson.dumps(analysis))
+            os.replace(tmp_path, cache_path)
+            entries = []
+            for entry in os.scandir(cache_path.parent):
+                if entry.name.endswith(".json"):
+                    entries.append((entry.stat().st_mtime, entry.path))
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.replace_cache_size)]:
+                os.remove(path)
+        except OSError as e:
+            print(f"⚠️  Не удалось сохранить кэш анализа комнаты: {e}")
+    
+    def _prepare_data_urls(self, image_paths: List[str]) -> List[Optional[str]]:
+        """
+        Data URL для анализа по каждому пути, в исходном порядке.
+        Файлы обрабатываются параллельно: время подготовки ≈ самый долгий файл, а не сумма.
+        """
+        if len(image_paths) < 2:
+            return [self.uploader.image_to_analysis_data_url(p) for p in image_paths]
+        return list(_prepare_pool.map(self.uploader.image_to_analysis_data_url, image_paths))
     
     def analyze_multi_furniture_placement(
         self,
@@ -41,20 +357,22 @@ class GPT4Analyzer:
             Словарь с анализом и параметрами размещения всех предметов
         """
         
+        cache_key = self._cache_key("multi", [room_image_path, *furniture_image_paths], manual_position)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             # Kie.ai возвращает 422 "Failed to get the file information" при ссылках на ImgBB — не может загрузить по URL.
-            # Поэтому для Gemini всегда передаём изображения в base64 (data URL).
+            # Поэтому для Gemini всегда передаём изображения в base64 (data URL), уменьшенные до 1024 px JPEG.
             print(f"📤 Подготовка изображений для Gemini (base64)...")
-            room_url = self.uploader.image_to_data_url(room_image_path)
+            room_url, *furniture_urls = self._prepare_data_urls([room_image_path, *furniture_image_paths])
             if not room_url:
                 raise ValueError("Не удалось прочитать изображение комнаты")
             
-            furniture_urls = []
-            for fpath in furniture_image_paths:
-                furl = self.uploader.image_to_data_url(fpath)
+            for fpath, furl in zip(furniture_image_paths, furniture_urls):
                 if not furl:
                     raise ValueError(f"Не удалось прочитать изображение мебели: {fpath}")
-                furniture_urls.append(furl)
             
             # Формируем промпт
             if manual_position:
@@ -69,27 +387,10 @@ class GPT4Analyzer:
             
             # Формируем content с комнатой + всеми предметами мебели
             content = [
-                {
-                    "type": "text",
-                    "text": full_prompt
-                },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": room_url
-                    }
-                }
+                {"type": "text", "text": full_prompt},
+                *({"type": "image_url", "image_url": {"url": url}} for url in (room_url, *furniture_urls))
             ]
             
-            # Добавляем все изображения мебели
-            for furl in furniture_urls:
-                content.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": furl
-                    }
-                })
-            
             # Подготавливаем payload
             payload = {
                 "messages": [
@@ -104,33 +405,7 @@ class GPT4Analyzer:
             }
             
             # Отправляем запрос к Kie.ai (с повтором при maintenance)
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            result = None
-            for attempt in range(KIE_RETRY_COUNT):
-                response = requests.post(
-                    self.api_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=90
-                )
-                result = response.json()
-                # 422 = Kie.ai не смог получить файл (при ссылках). Мы шлём base64 — 422 не должно быть.
-                if response.status_code == 422 or (result.get("code") == 422 and "file" in (result.get("msg") or "").lower()):
-                    raise ValueError(f"Gemini отклонил изображения: {result.get('msg', '')}")
-                response.raise_for_status()
-                
-                if result.get("code") == 500 and "maintained" in (result.get("msg") or "").lower():
-                    if attempt < KIE_RETRY_COUNT - 1:
-                        print(f"⏳ Kie.ai на обслуживании, повтор через {KIE_RETRY_DELAY} сек... ({attempt + 1}/{KIE_RETRY_COUNT})")
-                        time.sleep(KIE_RETRY_DELAY)
-                        continue
-                    raise ValueError("Kie.ai временно недоступен (maintenance). Попробуйте позже.")
-                
-                break
+            result = self._kie_call(payload, timeout=90)
             
             print(f"✅ Ответ от Gemini получен")
             
@@ -143,6 +418,7 @@ class GPT4Analyzer:
                     raise ValueError("Gemini вернул пустой content")
                 print(f"📝 Content от Gemini: {content_text[:200]}...")
                 analysis = self._parse_analysis(content_text)
+                self._cache_put(cache_key, analysis)
                 return analysis
             else:
                 print(f"⚠️  Нет choices в ответе. Ключи: {list(result.keys()) if result else []}")
@@ -162,16 +438,20 @@ class GPT4Analyzer:
         """
         try:
             print(f"📤 Подготовка изображения комнаты для анализа (base64)...")
-            room_url = self.uploader.image_to_data_url(room_image_path)
+            room_url = self.uploader.image_to_analysis_data_url(room_image_path)
             if not room_url:
                 raise ValueError("Не удалось прочитать изображение комнаты")
             
-            prompt = """Look at this room interior photo. List ONLY the furniture that you CLEARLY SEE in the image. Do NOT invent or assume anything that is not visible (e.g. if there is no bed, do not list a bed).
-For each item that is actually visible provide: "type" (one word in English: sofa, table, bed, chair, desk, cabinet, armchair, etc.) and "position" (left / center / right).
-CRITICAL: Include only items that are unambiguously present in the photo. If in doubt, omit the item.
-Return ONLY a valid JSON object, no markdown, no code block. Example:
-{"items": [{"type": "table", "position": "center"}, {"type": "chair", "position": "right"}]}
-If you see no clear furniture, return {"items": []}."""
+            cache_path = _replace_cache_path(room_url)
+            try:
+                cached = orjson.loads(cache_path.read_bytes())
+                os.utime(cache_path)  # отметка использования: вытесняются самые старые записи
+                print(f"♻️  Анализ комнаты взят из кэша")
+                return cached
+            except (OSError, orjson.JSONDecodeError):
+                pass
+            
+            prompt = _REPLACE_ROOM_PROMPT
             
             payload = {
                 "messages": [
@@ -187,23 +467,9 @@ If you see no clear furniture, return {"items": []}."""
                 "include_thoughts": False,
                 "reasoning_effort": "medium"
             }
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
             
-            for attempt in range(KIE_RETRY_COUNT):
-                response = requests.post(self.api_url, headers=headers, json=payload, timeout=60)
-                result = response.json()
-                if response.status_code == 422:
-                    raise ValueError("Не удалось отправить изображение в Gemini")
-                response.raise_for_status()
-                if result.get("code") == 500 and "maintained" in (result.get("msg") or "").lower():
-                    if attempt < KIE_RETRY_COUNT - 1:
-                        time.sleep(KIE_RETRY_DELAY)
-                        continue
-                    raise ValueError("Kie.ai временно недоступен")
-                break
+            # Отправляем запрос к Kie.ai (с повтором при maintenance)
+            result = self._kie_call(payload, timeout=60)
             
             if not result or 'choices' not in result or len(result['choices']) == 0:
                 return {"items": []}
@@ -214,7 +480,7 @@ If you see no clear furniture, return {"items": []}."""
             text = content.strip()
             if text.startswith("```"):
                 text = text.split("\n", 1)[-1].rsplit("```", 1)[0].strip()
-            data = json.loads(text)
+            data = orjson.loads(text)
             items = data.get("items", [])
             if not isinstance(items, list):
                 return {"items": []}
@@ -226,8 +492,9 @@ If you see no clear furniture, return {"items": []}."""
                         "type": str(it.get("type", "")).strip().lower() or "furniture",
                         "position": str(it.get("position", "center")).strip().lower() or "center"
                     })
+            self._replace_cache_put(cache_path, {"items": out})
             return {"items": out}
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"⚠️  Не удалось распарсить JSON анализа комнаты: {e}")
             return {"items": []}
         except Exception as e:
@@ -252,11 +519,15 @@ If you see no clear furniture, return {"items": []}."""
             Словарь с анализом и параметрами размещения
         """
         
+        cache_key = self._cache_key("single", [room_image_path, furniture_image_path], manual_position)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
         try:
             # Для Gemini передаём base64 (Kie.ai даёт 422 на внешние URL ImgBB)
             print(f"📤 Подготовка изображений для Gemini (base64)...")
-            room_url = self.uploader.image_to_data_url(room_image_path)
-            furniture_url = self.uploader.image_to_data_url(furniture_image_path)
+            room_url, furniture_url = self._prepare_data_urls([room_image_path, furniture_image_path])
             if not room_url or not furniture_url:
                 raise ValueError("Не удалось прочитать изображения")
             
@@ -302,32 +573,7 @@ If you see no clear furniture, return {"items": []}."""
             }
             
             # Отправляем запрос к Kie.ai (с повтором при maintenance)
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            result = None
-            for attempt in range(KIE_RETRY_COUNT):
-                response = requests.post(
-                    self.api_url,
-                    headers=headers,
-                    json=payload,
-                    timeout=60
-                )
-                result = response.json()
-                if response.status_code == 422 or (result.get("code") == 422 and "file" in (result.get("msg") or "").lower()):
-                    raise ValueError(f"Gemini отклонил изображения: {result.get('msg', '')}")
-                response.raise_for_status()
-                
-                if result.get("code") == 500 and "maintained" in (result.get("msg") or "").lower():
-                    if attempt < KIE_RETRY_COUNT - 1:
-                        print(f"⏳ Kie.ai на обслуживании, повтор через {KIE_RETRY_DELAY} сек... ({attempt + 1}/{KIE_RETRY_COUNT})")
-                        time.sleep(KIE_RETRY_DELAY)
-                        continue
-                    raise ValueError("Kie.ai временно недоступен (maintenance). Попробуйте позже.")
-                
-                break
+            result = self._kie_call(payload, timeout=60)
             
             print(f"✅ Ответ от Gemini получен")
             
@@ -340,6 +586,7 @@ If you see no clear furniture, return {"items": []}."""
                     raise ValueError("Gemini вернул пустой content")
                 print(f"📝 Content от Gemini: {content[:200]}...")
                 analysis = self._parse_analysis(content)
+                self._cache_put(cache_key, analysis)
                 return analysis
             else:
                 print(f"⚠️  Нет choices в ответе. Ключи: {list(result.keys()) if result else []}")
@@ -349,167 +596,31 @@ If you see no clear furniture, return {"items": []}."""
             print(f"❌ Ошибка при анализе с Gemini: {e}")
             raise
     
-    def _create_auto_placement_prompt(self) -> Dict[str, str]:
+    def _create_auto_placement_prompt(self) -> Mapping[str, str]:
         """Создает промпт для автоматического размещения"""
-        return {
-            "system": """Ты эксперт по интерьерному дизайну и 3D-композиции.
-Твоя задача - проанализировать фото комнаты и мебели, определить ЛУЧШЕЕ место для размещения мебели.
-
-КРИТИЧЕСКИ ВАЖНО: 
-- Комната и мебель должны остаться ПОЛНОСТЬЮ неизменными!
-- Описывай мебель МАКСИМАЛЬНО точно и детально
-- Укажи ТОЧНЫЙ цвет, ТОЧНУЮ форму, ТОЧНЫЕ детали
-- Ты определяешь только область куда вставить мебель БЕЗ изменения её внешнего вида
-- Учитывай перспективу, освещение, пропорции
-
-Верни ответ СТРОГО в JSON формате.""",
-            
-            "user": """Проанализируй эти изображения:
-1. Первое изображение - комната
-2. Второе изображение - мебель
-
-Определи:
-1. Характеристики комнаты (размер, освещение, стиль, перспектива)
-2. Характеристики мебели - БУДЬ МАКСИМАЛЬНО ТОЧНЫМ В ОПИСАНИИ!
-3. ЛУЧШЕЕ место для размещения мебели
-
-Верни JSON:
-{
-  "room_analysis": {
-    "size_estimate": "примерный размер в метрах",
-    "lighting": "описание освещения",
-    "style": "стиль интерьера",
-    "perspective": "описание перспективы камеры",
-    "free_spaces": ["список свободных мест"]
-  },
-  "furniture_analysis": {
-    "type": "тип мебели (диван, кресло, стол...)",
-    "estimated_size": "примерный размер в метрах",
-    "style": "детальное описание стиля",
-    "color": "ТОЧНЫЙ цвет с оттенком (например: 'deep purple', 'burgundy', 'dark violet')",
-    "features": ["детальные особенности: форма подлокотников, тип обивки, наличие подушек, форма ножек и т.д."]
-  },
-  "placement": {
-    "x_percent": 50,
-    "y_percent": 60,
-    "width_percent": 35,
-    "height_percent": 25,
-    "scale": 0.85,
-    "rotation": 15,
-    "reasoning": "почему это лучшее место"
-  },
-  "inpainting_prompt": "НЕ используется - оставь пустым"
-}
-
-ВАЖНО: 
-- Опиши цвет мебели МАКСИМАЛЬНО точно
-- Опиши все визуальные детали мебели
-- Укажи материал и текстуру если видно
-
-Координаты в процентах от размера изображения."""
-        }
+        return _AUTO_PLACEMENT_PROMPT
     
     def _create_manual_placement_prompt(self, position: Tuple[int, int]) -> Dict[str, str]:
         """Создает промпт для ручного размещения"""
         x, y = position
         return {
-            "system": """Ты эксперт по интерьерному дизайну.
-Пользователь указал конкретное место где хочет разместить мебель.
-Твоя задача - определить правильный размер и параметры для этого места.
-
-ВАЖНО: НЕ меняй детали комнаты!""",
-            
-            "user": f"""Пользователь хочет разместить мебель в позиции ({x}, {y}).
-
-Проанализируй:
-1. Подходит ли это место для данной мебели
-2. Какой размер должна иметь мебель в этом месте
-3. Под каким углом её разместить
-
-Изображения:
-1. Первое - комната
-2. Второе - мебель
-
-Верни JSON как в предыдущем примере, но используй указанную позицию."""
+            "system": _MANUAL_PLACEMENT_SYSTEM,
+            "user": _MANUAL_PLACEMENT_USER_TEMPLATE.format(x=x, y=y)
         }
     
     def _create_multi_auto_placement_prompt(self, furniture_count: int) -> Dict[str, str]:
         """Создает промпт для автоматического размещения нескольких предметов"""
         return {
-            "system": f"""Ты эксперт по интерьерному дизайну и 3D-композиции.
-Твоя задача - проанализировать фото комнаты и {furniture_count} предметов мебели, определить ЛУЧШЕЕ размещение для КАЖДОГО предмета так, чтобы они гармонично сочетались.
-
-КРИТИЧЕСКИ ВАЖНО:
-- Все предметы должны остаться ПОЛНОСТЬЮ неизменными!
-- Опис
-
-ывай каждый предмет МАКСИМАЛЬНО точно и детально
-- Укажи ТОЧНЫЙ цвет, ТОЧНУЮ форму, ТОЧНЫЕ детали каждого
-- Размещай предметы так, чтобы они не перекрывали друг друга
-- Учитывай перспективу, освещение, пропорции
-
-Верни ответ СТРОГО в JSON формате.""",
-            
-            "user": f"""Проанализируй эти изображения:
-1. Первое изображение - комната
-2. Следующие {furniture_count} изображений - предметы мебели
-
-Определи для КАЖДОГО предмета:
-1. Характеристики (тип, размер, цвет, стиль)
-2. ЛУЧШЕЕ место для размещения
-3. Как предметы сочетаются между собой
-
-Верни JSON:
-{{
-  "room_analysis": {{
-    "size_estimate": "примерный размер в метрах",
-    "lighting": "описание освещения",
-    "style": "стиль интерьера",
-    "perspective": "описание перспективы камеры",
-    "free_spaces": ["список свободных мест"]
-  }},
-  "furniture_items": [
-    {{
-      "index": 0,
-      "type": "тип мебели",
-      "estimated_size": "размер",
-      "style": "стиль",
-      "color": "ТОЧНЫЙ цвет",
-      "features": ["особенности"],
-      "placement": {{
-        "x_percent": 50,
-        "y_percent": 60,
-        "width_percent": 35,
-        "height_percent": 25,
-        "scale": 0.85,
-        "rotation": 15,
-        "reasoning": "почему это место"
-      }}
-    }}
-  ],
-  "overall_composition": "как предметы сочетаются между собой"
-}}
-
-Координаты в процентах от размера изображения."""
+            "system": _MULTI_AUTO_SYSTEM_TEMPLATE.format(furniture_count=furniture_count),
+            "user": _MULTI_AUTO_USER_TEMPLATE.format(furniture_count=furniture_count)
         }
     
     def _create_multi_manual_placement_prompt(self, position: Tuple[int, int], furniture_count: int) -> Dict[str, str]:
         """Создает промпт для ручного размещения нескольких предметов"""
         x, y = position
         return {
-            "system": f"""Ты эксперт по интерьерному дизайну.
-Пользователь указал место где хочет разместить {furniture_count} предметов мебели.
-Определи размеры и параметры для каждого предмета.""",
-            
-            "user": f"""Пользователь выбрал позицию ({x}, {y}) для размещения {furniture_count} предметов.
-
-Проанализируй все предметы и определи их оптимальное размещение в этой области.
-
-Изображения:
-1. Первое - комната
-2. Следующие {furniture_count} - предметы мебели
-
-Верни JSON в том же формате что и для автоматического размещения."""
+            "system": _MULTI_MANUAL_SYSTEM_TEMPLATE.format(furniture_count=furniture_count),
+            "user": _MULTI_MANUAL_USER_TEMPLATE.format(x=x, y=y, furniture_count=furniture_count)
         }
     
     def _parse_analysis(self, content: str) -> Dict[str, Any]:
@@ -524,23 +635,14 @@ If you see no clear furniture, return {"items": []}."""
         """
         try:
             # Ищем JSON в ответе (может быть обернут в markdown)
-            if "```json" in content:
-                json_start = content.find("```json") + 7
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            elif "```" in content:
-                json_start = content.find("```") + 3
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            else:
-                json_str = content.strip()
+            match = _FENCED_JSON_RE.search(content)
+            json_str = (match.group(1) if match else content).strip()
             
-            # Парсим JSON
-            analysis = json.loads(json_str)
+            analysis = orjson.loads(json_str)
             
             return analysis
             
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"⚠️  Ошибка парсинга JSON от GPT-4V: {e}")
             print(f"Ответ: {content}")
             
@@ -2,17 +2,105 @@
 Сервис для создания публичных URL для изображений
 Использует ImgBB API для стабильной загрузки
 """
+import io
+import mmap
+import os
+import threading
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
 from pathlib import Path
+import orjson
 import requests
-import base64
+from PIL import Image
 from ..utils.load_env import get_env_variable
+from ..utils.http_session import get_shared_session, backoff_delay
+
+# pybase64 — SIMD-кодек (AVX2/AVX-512/NEON) с тем же API, что и base64; без него — стандартный модуль
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
 
 IMGBB_RETRIES = 3
-IMGBB_RETRY_DELAY = 8
+IMGBB_RETRY_BASE_DELAY = 4  # 4–6 сек, затем 8–12 сек
 IMGBB_TIMEOUT = 45
 
+# Nano Banana генерирует в 1K — входы больше 2048 px по длинной стороне только увеличивают загрузку на ImgBB
+UPLOAD_MAX_EDGE = 2048
+UPLOAD_JPEG_QUALITY = 90
+
+# Для анализа (Gemini) хватает 1024 px по длинной стороне: JPEG q85 в 3–5 раз меньше исходного PNG/фото
+ANALYSIS_MAX_EDGE = 1024
+ANALYSIS_JPEG_QUALITY = 85
+
+
+# Готовые data URL по (вид, путь, mtime, размер): повторный анализ/генерация с теми же файлами
+# (смена режима, поворота) не читает и не кодирует их заново
+DATA_URL_CACHE_SIZE = 32
+
+# Кратно 3 байтам: base64 каждого куска без паддинга, куски просто склеиваются
+B64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def _b64encode_file(image_path: str, prefix: bytes = b"") -> bytearray:
+    """
+    base64 файла кусками в один bytearray (с необязательным префиксом, например 'data:...;base64,').
+    Файл отображается в память (mmap), куски — срезы memoryview без копирования:
+    в куче Python не появляется ни копия файла, ни его base64 целиком отдельно от результата.
+    """
+    size = os.path.getsize(image_path)
+    out = bytearray(len(prefix) + 4 * ((size + 2) // 3))
+    out[:len(prefix)] = prefix
+    if size == 0:
+        return out  # mmap не отображает пустые файлы
+    pos = len(prefix)
+    with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) != size:
+            raise IOError(f"файл изменился во время чтения: {image_path}")
+        view = memoryview(mm)
+        try:
+            for start in range(0, size, B64_CHUNK_SIZE):
+                encoded = base64.b64encode(view[start:start + B64_CHUNK_SIZE])
+                out[pos:pos + len(encoded)] = encoded
+                pos += len(encoded)
+        finally:
+            view.release()
+    return out
+
+
+def _data_url(data: bytes, mime: str) -> str:
+    """
+    data URL из байтов изображения: префикс и base64 склеиваются как bytes, в str — один раз в конце
+    (ASCII-декодирование без промежуточной строки base64 и f-string копии).
+    """
+    out = bytearray(b"data:")
+    out += mime.encode('ascii')
+    out += b";base64,"
+    out += base64.b64encode(data)
+    return out.decode('ascii')
+
+
+def _downscaled_image_bytes(image_path: str, max_edge: int, quality: int) -> Optional[Tuple[bytes, str]]:
+    """
+    Уменьшенная копия изображения (LANCZOS до max_edge по длинной стороне) и её MIME-тип,
+    или None, если уменьшать не нужно. Изображения с прозрачностью остаются PNG, остальные кодируются в JPEG.
+    """
+    with Image.open(image_path) as img:
+        if max(img.size) <= max_edge:
+            return None
+        has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        if has_alpha:
+            img.save(buf, 'PNG')
+            mime = 'image/png'
+        else:
+            img.save(buf, 'JPEG', quality=quality)
+            mime = 'image/jpeg'
+    return buf.getvalue(), mime
+
 
 class ImageUploader:
     """
@@ -25,14 +113,45 @@ class ImageUploader:
         except ValueError:
             self.api_key = ''
         self.api_url = "https://api.imgbb.com/1/upload"
+        # Keep-alive к api.imgbb.com: повторные загрузки и ретраи без нового TLS-рукопожатия
+        self._http = get_shared_session()
+        self._data_url_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._cache_lock = threading.Lock()
     
-    def upload_image(self, image_path: str, expiration: int = 600) -> Optional[str]:
+    def _cached_data_url(self, kind: str, image_path: str, build: Callable[[], Optional[str]]) -> Optional[str]:
+        """LRU-кэш data URL; перезаписанный файл (другие mtime/размер) получает новый ключ. None не кэшируется."""
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            return build()
+        key = (kind, os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+        with self._cache_lock:
+            url = self._data_url_cache.get(key)
+            if url is not None:
+                self._data_url_cache.move_to_end(key)
+                return url
+        url = build()
+        if url is not None:
+            with self._cache_lock:
+                self._data_url_cache[key] = url
+                while len(self._data_url_cache) > DATA_URL_CACHE_SIZE:
+                    self._data_url_cache.popitem(last=False)
+        return url
+    
+    def upload_image(
+        self,
+        image_path: str,
+        expiration: int = 600,
+        max_edge: Optional[int] = UPLOAD_MAX_EDGE
+    ) -> Optional[str]:
         """
         Загружает изображение на ImgBB (с повторами при 503/таймауте).
+        Большие фото перед загрузкой уменьшаются; файл на диске остаётся в полном разрешении.
         
         Args:
             image_path: Путь к изображению
             expiration: Время жизни в секундах (600 = 10 минут)
+            max_edge: Максимальная длинная сторона загружаемой копии (None — загрузить как есть)
             
         Returns:
             Публичный URL изображения или None
@@ -42,8 +161,9 @@ class ImageUploader:
             return None
         
         try:
-            with open(image_path, 'rb') as file:
-                image_data = base64.b64encode(file.read()).decode('utf-8')
+            downscaled = _downscaled_image_bytes(image_path, max_edge, UPLOAD_JPEG_QUALITY) if max_edge else None
+            encoded = base64.b64encode(downscaled[0]) if downscaled else _b64encode_file(image_path)
+            image_data = encoded.decode('ascii')
         except Exception as e:
             print(f"❌ Не удалось прочитать файл: {e}")
             return None
@@ -58,9 +178,9 @@ class ImageUploader:
         for attempt in range(IMGBB_RETRIES):
             try:
                 print(f"📤 Загрузка на ImgBB... (попытка {attempt + 1}/{IMGBB_RETRIES})")
-                response = requests.post(self.api_url, data=payload, timeout=IMGBB_TIMEOUT)
+                response = self._http.post(self.api_url, data=payload, timeout=IMGBB_TIMEOUT)
                 response.raise_for_status()
-                result = response.json()
+                result = orjson.loads(response.content)
                 if result.get('success'):
                     url = result['data']['url']
                     print(f"✅ Изображение загружено на ImgBB: {url}")
@@ -69,13 +189,15 @@ class ImageUploader:
             except requests.exceptions.Timeout as e:
                 last_error = e
                 if attempt < IMGBB_RETRIES - 1:
-                    print(f"⏳ Таймаут ImgBB, повтор через {IMGBB_RETRY_DELAY} сек...")
-                    time.sleep(IMGBB_RETRY_DELAY)
+                    delay = backoff_delay(attempt, IMGBB_RETRY_BASE_DELAY)
+                    print(f"⏳ Таймаут ImgBB, повтор через {delay:.1f} сек...")
+                    time.sleep(delay)
             except requests.exceptions.HTTPError as e:
                 last_error = e
                 if response.status_code == 503 and attempt < IMGBB_RETRIES - 1:
-                    print(f"⏳ ImgBB 503, повтор через {IMGBB_RETRY_DELAY} сек...")
-                    time.sleep(IMGBB_RETRY_DELAY)
+                    delay = backoff_delay(attempt, IMGBB_RETRY_BASE_DELAY)
+                    print(f"⏳ ImgBB 503, повтор через {delay:.1f} сек...")
+                    time.sleep(delay)
                 else:
                     break
             except Exception as e:
@@ -85,21 +207,85 @@ class ImageUploader:
         print(f"❌ Ошибка при загрузке на ImgBB после {IMGBB_RETRIES} попыток: {last_error}")
         return None
     
-    def image_to_data_url(self, image_path: str) -> Optional[str]:
+    def image_url_for_api(
+        self,
+        image_path: str,
+        prefer_data_url: bool = False,
+        max_edge: Optional[int] = UPLOAD_MAX_EDGE
+    ) -> Optional[str]:
+        """
+        Ссылка на изображение для API генерации: публичный URL ImgBB, при недоступности — data URL.
+        prefer_data_url=True — сразу data URL, без загрузки на ImgBB (лишний сетевой круг), для API, принимающих data:image/...
+        max_edge — до какой длинной стороны уменьшить копию (None — как есть).
+        """
+        if not prefer_data_url:
+            url = self.upload_image(image_path, expiration=600, max_edge=max_edge)
+            if url:
+                return url
+        url = self.image_to_data_url(image_path, max_edge=max_edge)
+        if url:
+            print(f"✅ {Path(image_path).name} передано в base64" + ("" if prefer_data_url else " (ImgBB недоступен)"))
+        return url
+    
+    def image_to_data_url(self, image_path: str, max_edge: Optional[int] = UPLOAD_MAX_EDGE) -> Optional[str]:
         """
         Возвращает data URL (base64) для изображения — запасной вариант без ImgBB.
         Подходит для API, которые принимают data:image/... в url.
+        Как и при загрузке на ImgBB, большие фото уменьшаются до max_edge (None — передать как есть).
         """
+        return self._cached_data_url(f"data:{max_edge}", image_path, lambda: self._build_data_url(image_path, max_edge))
+    
+    def _build_data_url(self, image_path: str, max_edge: Optional[int]) -> Optional[str]:
+        """Собирает data URL для image_to_data_url (без кэша)."""
         try:
+            downscaled = _downscaled_image_bytes(image_path, max_edge, UPLOAD_JPEG_QUALITY) if max_edge else None
+            if downscaled:
+                data, mime = downscaled
+                return _data_url(data, mime)
+            
             ext = (Path(image_path).suffix or "").lower()
             mime = "image/png"
             if ext in (".jpg", ".jpeg"):
                 mime = "image/jpeg"
             elif ext == ".webp":
                 mime = "image/webp"
-            with open(image_path, 'rb') as f:
-                b64 = base64.b64encode(f.read()).decode('utf-8')
-            return f"data:{mime};base64,{b64}"
+            return _b64encode_file(image_path, prefix=f"data:{mime};base64,".encode('ascii')).decode('ascii')
         except Exception as e:
             print(f"❌ Ошибка чтения для data URL: {e}")
             return None
+    
+    def image_to_analysis_data_url(
+        self,
+        image_path: str,
+        max_edge: int = ANALYSIS_MAX_EDGE,
+        quality: int = ANALYSIS_JPEG_QUALITY
+    ) -> Optional[str]:
+        """
+        Data URL для анализа изображения моделью: уменьшаем до max_edge по длинной стороне (LANCZOS)
+        и кодируем в JPEG. Для генерации не подходит — там нужен исходник без потерь.
+        """
+        return self._cached_data_url(
+            f"analysis:{max_edge}:{quality}",
+            image_path,
+            lambda: self._build_analysis_data_url(image_path, max_edge, quality)
+        )
+    
+    def _build_analysis_data_url(self, image_path: str, max_edge: int, quality: int) -> Optional[str]:
+        """Собирает data URL для image_to_analysis_data_url (без кэша)."""
+        try:
+            # mmap: сжатый файл не копируется целиком в память Python, декодер читает из кэша ОС
+            with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, Image.open(mm) as img:
+                if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                    rgba = img.convert('RGBA')
+                    img = Image.new('RGB', rgba.size, (255, 255, 255))
+                    img.paste(rgba, mask=rgba.split()[3])
+                else:
+                    img = img.convert('RGB')
+                if max(img.size) > max_edge:
+                    img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+                buf = io.BytesIO()
+                img.save(buf, 'JPEG', quality=quality)
+            return _data_url(buf.getbuffer(), 'image/jpeg')
+        except Exception as e:
+            print(f"❌ Ошибка подготовки изображения для анализа: {e}")
+            return None
@@ -2,20 +2,126 @@
 Сервис для редактирования изображений с помощью Nano Banana Pro через Kie.ai
 Google DeepMind's Nano Banana Pro - улучшенное качество 2K/4K
 """
+import hashlib
+import random
+import shutil
+import threading
 import time
 import requests
-import json
+import orjson
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from PIL import Image
 import uuid
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from ..utils.load_env import get_env_variable
-from ..utils.image_utils import download_image, create_furniture_collage
-from .image_uploader import ImageUploader
+from ..utils.load_env import get_env_variable, get_env_optional
+from ..utils.http_session import get_shared_session, backoff_delay
+from ..utils.image_utils import download_image, create_furniture_collage, get_image_size
+from .image_uploader import ImageUploader, UPLOAD_MAX_EDGE
 from .base_inpainting import BaseInpaintingService
 
+# Загрузки изображений одной генерации (комната, мебель/коллаж) независимы — идут параллельно:
+# ожидание ≈ самая долгая загрузка, а не сумма. Пул общий на процесс (несколько генераций одновременно)
+UPLOAD_WORKERS = 8
+_upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="kie-upload")
+
+# Комната — холст результата в 1K: больше 1280 px по длинной стороне модель всё равно не использует,
+# а загрузка (клиент → ImgBB → Kie.ai) у фото с телефона в 5–20 раз меньше. Мебель — UPLOAD_MAX_EDGE (детали текстуры)
+ROOM_UPLOAD_MAX_EDGE = 1280
+
+# Опрос задачи: пока она в очереди (waiting/queuing), интервал растёт 1 → 1.5 → 2.25 … до 5 сек;
+# на стадии generating — каждые 0.5 сек. Джиттер разносит опросы одновременных генераций
+POLL_TIMEOUT = 480  # 8 минут, как прежние 240 попыток по 2 сек
+POLL_BASE_DELAY = 1.0
+POLL_MAX_DELAY = 5.0
+POLL_GENERATING_DELAY = 0.5
+POLL_JITTER = 0.5
+
+# Кэш результатов генерации: те же изображения (по содержимому) + тот же промпт и параметры →
+# копия готового результата вместо новой задачи Kie.ai (~60–80 сек и платно). Записи вытесняются по давности использования.
+# По умолчанию выключен: «перегенерировать» с теми же фото должно давать новый вариант, а не прежний PNG
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+RESULT_CACHE_DIR = BASE_DIR / "data" / "cache" / "generations"
+RESULT_CACHE_SIZE = 0
+
+# Промпт размещения одного предмета: шаблон собирается один раз, на запрос — один format_map
+_PLACEMENT_PROMPT_TEMPLATE = """Seamlessly integrate the exact {furniture_color} {furniture_type} from the second image into the {room_style} room from the first image.
+
+CRITICAL: Preserve the EXACT appearance of the furniture - same color, texture, and design.
+
+Placement: {placement}
+{rotation_hint}
+{wall_hint}
+
+Requirements:
+- Match the room's {room_lighting}
+- Add realistic shadows and reflections
+- Adjust perspective to fit naturally
+- Maintain photorealistic quality
+- Keep furniture IDENTICAL to the original image
+- Blend seamlessly with the interior
+- CRITICAL: Place furniture ON THE FLOOR, standing normally. Do NOT put it on the wall or vertically. Beds horizontal on the floor, chairs/sofas upright with legs on the ground.
+
+Output in high resolution with sharp details."""
+_BBOX_HINT_TEMPLATE = (
+    "Place the furniture centered at approximately {x:.1f}% from the left and "
+    "{y:.1f}% from the top. Fit it inside a rectangle of about "
+    "{w:.1f}% width and {h:.1f}% height of the room image."
+)
+_ROTATION_HINT = "The furniture is rotated 90 degrees to match the user's requested orientation (vertical vs horizontal)."
+_WALL_HINT_TEMPLATE = (
+    "IMPORTANT: Place the sofa ALONG the {wall_name}, parallel to it, and flush against it. "
+    "Do NOT place it perpendicular across the room."
+)
+_WALL_NAMES = {"right": "right wall", "left": "left wall", "back": "back wall"}
+
+# Стандартные aspect ratio Nano Banana: (нижняя граница, верхняя граница, значение для API), границы не включаются
+_ASPECT_RATIOS = (
+    (0.95, 1.05, "1:1"),
+    (1.3, 1.4, "4:3"),
+    (1.5, 1.6, "3:2"),
+    (1.7, 1.9, "16:9"),
+    (2.2, 2.4, "21:9"),
+    (0.6, 0.7, "2:3"),
+    (0.7, 0.8, "3:4"),
+    (0.5, 0.6, "9:16"),
+)
+
+
+class _InflightTask:
+    """Выполняющаяся генерация: одинаковые запросы ждут её future вместо новой задачи Kie.ai."""
+    __slots__ = ("future", "waiters")
+    
+    def __init__(self):
+        self.future: Future = Future()
+        self.waiters = 0
+
+
+# Генерации в работе: ключ задачи (как у кэша результатов) -> _InflightTask
+_inflight: Dict[str, _InflightTask] = {}
+_inflight_lock = threading.Lock()
+
+# Задачи, ожидающие результата: taskId -> Event. Callback Kie.ai (KIE_CALLBACK_URL) будит опрос сразу,
+# не дожидаясь конца паузы; без callback остаётся обычный опрос по расписанию выше
+_task_events: Dict[str, threading.Event] = {}
+_task_events_lock = threading.Lock()
+
+
+def notify_task_finished(task_id: str) -> bool:
+    """
+    Будит опрос задачи task_id (вызывается из endpoint callback Kie.ai).
+    Результат всё равно забирается через recordInfo — callback лишь убирает ожидание до следующего опроса.
+    Returns: False, если такую задачу никто не ждёт.
+    """
+    with _task_events_lock:
+        event = _task_events.get(task_id)
+    if event is None:
+        return False
+    event.set()
+    return True
+
 
 class NanoBananaService(BaseInpaintingService):
     """
@@ -34,6 +140,25 @@ class NanoBananaService(BaseInpaintingService):
         
         # Image uploader для создания публичных URL
         self.uploader = ImageUploader()
+        # Общая keep-alive сессия: createTask, опросы recordInfo и скачивание результата идут без новых TLS-рукопожатий
+        self._http = get_shared_session()
+        # KIE_PREFER_DATA_URLS=true — передавать изображения сразу в base64, без загрузки на ImgBB
+        self.prefer_data_urls = get_env_optional('KIE_PREFER_DATA_URLS').strip().lower() in ('1', 'true', 'yes')
+        # KIE_CALLBACK_URL — публичный адрес /api/kie/callback: Kie.ai сообщит о завершении задачи сам
+        self.callback_url = get_env_optional('KIE_CALLBACK_URL').strip()
+        # GENERATION_CACHE_SIZE — сколько результатов хранить в кэше (0 — не кэшировать, по умолчанию)
+        self.result_cache_size = int(get_env_optional('GENERATION_CACHE_SIZE') or RESULT_CACHE_SIZE)
+    
+    def _image_urls(self, image_paths: List[str], max_edges: List[Optional[int]]) -> List[Optional[str]]:
+        """
+        Ссылки для API по каждому пути (ImgBB или data URL), в исходном порядке; загрузки идут параллельно.
+        max_edges — длинная сторона загружаемой копии для каждого пути.
+        """
+        return list(_upload_pool.map(
+            lambda p, edge: self.uploader.image_url_for_api(p, self.prefer_data_urls, edge),
+            image_paths,
+            max_edges
+        ))
     
     def place_multi_furniture(
         self,
@@ -99,65 +224,20 @@ class NanoBananaService(BaseInpaintingService):
         output_dir: Path
     ) -> str:
         """Один запрос к API: комната + коллаж мебели, промпт с позициями для каждого предмета."""
-        rotated_path = None
         try:
-            print(f"📤 Загрузка изображения комнаты на хостинг...")
-            room_url = self.uploader.upload_image(room_image_path, expiration=600)
-            if not room_url:
-                room_url = self.uploader.image_to_data_url(room_image_path)
-                if room_url:
-                    print(f"✅ Комната в base64 (ImgBB недоступен)")
-            if not room_url:
-                raise ValueError("Не удалось загрузить изображение комнаты")
-            
-            print(f"📤 Загрузка коллажа мебели на хостинг...")
-            collage_url = self.uploader.upload_image(collage_path, expiration=600)
-            if not collage_url:
-                collage_url = self.uploader.image_to_data_url(collage_path)
-                if collage_url:
-                    print(f"✅ Коллаж в base64")
-            if not collage_url:
-                raise ValueError("Не удалось загрузить коллаж мебели")
-            
             prompt = self._create_multi_placement_prompt(
                 placement_params,
                 len(furniture_image_paths)
             )
+            aspect_ratio = self._get_aspect_ratio(get_image_size(room_image_path))
             
-            room_img = Image.open(room_image_path)
-            aspect_ratio = self._get_aspect_ratio(room_img.size)
-            
-            payload = {
-                "model": self.model_name,
-                "input": {
-                    "prompt": prompt,
-                    "image_input": [room_url, collage_url],
-                    "aspect_ratio": aspect_ratio,
-                    "resolution": "1K",
-                    "output_format": "png"
-                }
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(self.api_url, headers=headers, json=payload, timeout=30)
-            print(f"📡 HTTP статус: {response.status_code}")
-            response.raise_for_status()
-            result = response.json()
-            
-            if result.get("code") != 200:
-                raise ValueError(f"Nano Banana Pro API: {result.get('message')}")
-            
-            data = result.get("data", {})
-            task_id = data.get("taskId")
-            if not task_id:
-                raise ValueError("Нет taskId в ответе")
-            
-            print(f"📋 Задача в очереди, taskId: {task_id}")
-            return self._query_task_result(task_id, output_dir)
+            print(f"📤 Загрузка изображений комнаты и коллажа мебели на хостинг...")
+            return self._run_task(
+                [(room_image_path, "изображение комнаты"), (collage_path, "коллаж мебели")],
+                prompt,
+                aspect_ratio,
+                output_dir
+            )
             
         finally:
             try:
@@ -180,46 +260,14 @@ class NanoBananaService(BaseInpaintingService):
         """
         try:
             print(f"🔄 Режим замены: подставляем новую мебель вместо старой в комнате...")
-            room_url = self.uploader.upload_image(room_image_path, expiration=600)
-            if not room_url:
-                room_url = self.uploader.image_to_data_url(room_image_path)
-            if not room_url:
-                raise ValueError("Не удалось загрузить изображение комнаты")
-            
-            furniture_url = self.uploader.upload_image(furniture_image_path, expiration=600)
-            if not furniture_url:
-                furniture_url = self.uploader.image_to_data_url(furniture_image_path)
-            if not furniture_url:
-                raise ValueError("Не удалось загрузить изображение новой мебели")
-            
             prompt = self._create_replace_prompt(replace_what)
-            room_img = Image.open(room_image_path)
-            aspect_ratio = self._get_aspect_ratio(room_img.size)
-            
-            payload = {
-                "model": self.model_name,
-                "input": {
-                    "prompt": prompt,
-                    "image_input": [room_url, furniture_url],
-                    "aspect_ratio": aspect_ratio,
-                    "resolution": "1K",
-                    "output_format": "png"
-                }
-            }
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.post(self.api_url, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()
-            result = response.json()
-            if result.get("code") != 200:
-                raise ValueError(f"Nano Banana Pro API: {result.get('message')}")
-            data = result.get("data", {})
-            task_id = data.get("taskId")
-            if not task_id:
-                raise ValueError("Нет taskId в ответе")
-            return self._query_task_result(task_id, output_dir)
+            aspect_ratio = self._get_aspect_ratio(get_image_size(room_image_path))
+            return self._run_task(
+                [(room_image_path, "изображение комнаты"), (furniture_image_path, "изображение новой мебели")],
+                prompt,
+                aspect_ratio,
+                output_dir
+            )
         except Exception as e:
             print(f"❌ Ошибка замены мебели: {e}")
             raise
@@ -278,21 +326,11 @@ TASK: REPLACE the existing furniture in the room with the new furniture from the
         Returns:
             Путь к результирующему изображению
         """
+        rotated_path = None
         try:
-            # Загружаем изображение комнаты на хостинг (ImgBB). При недоступности — data URL
-            print(f"📤 Загрузка изображения комнаты на хостинг...")
-            room_url = self.uploader.upload_image(room_image_path, expiration=600)
-            if not room_url:
-                room_url = self.uploader.image_to_data_url(room_image_path)
-                if room_url:
-                    print(f"✅ Комната передана в base64 (ImgBB недоступен)")
-            if not room_url:
-                raise ValueError("Не удалось загрузить изображение комнаты на хостинг")
-            
             # Поворот мебели если выбран (0/90)
             placement = placement_params.get("placement", {}) or {}
             rotation = placement.get("rotation", 0)
-            rotated_path = None
             upload_path = furniture_image_path
             if rotation in (90, "90"):
                 print("🔄 Поворот мебели на 90°...")
@@ -302,79 +340,24 @@ TASK: REPLACE the existing furniture in the room with the new furniture from the
                 img.save(rotated_path)
                 upload_path = rotated_path
 
-            # Загружаем изображение мебели на хостинг (ImgBB). При недоступности — data URL
-            print(f"📤 Загрузка изображения мебели на хостинг...")
-            furniture_url = self.uploader.upload_image(upload_path, expiration=600)
-            if not furniture_url:
-                furniture_url = self.uploader.image_to_data_url(upload_path)
-                if furniture_url:
-                    print(f"✅ Мебель передана в base64 (ImgBB недоступен)")
-            if not furniture_url:
-                raise ValueError("Не удалось загрузить изображение мебели на хостинг")
-            
             # Формируем промпт для Nano Banana Pro
             prompt = self._create_prompt(placement_params)
             
             print(f"🍌 Запуск Nano Banana Pro (Google DeepMind) на Kie.ai...")
             print(f"   Промпт: {prompt}")
-            print(f"   Комната URL: {room_url}")
-            print(f"   Мебель URL: {furniture_url}")
             
             # Определяем aspect ratio из размеров комнаты
-            room_img = Image.open(room_image_path)
-            aspect_ratio = self._get_aspect_ratio(room_img.size)
-            
-            # Подготавливаем payload согласно документации Nano Banana Pro
-            payload = {
-                "model": self.model_name,
-                "input": {
-                    "prompt": prompt,
-                    "image_input": [room_url, furniture_url],  # До 8 изображений
-                    "aspect_ratio": aspect_ratio,
-                    "resolution": "1K",  # 1K быстрее; при необходимости можно вернуть 2K
-                    "output_format": "png"
-                }
-            }
-            
-            # Отправляем запрос к Kie.ai API
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                self.api_url,
-                headers=headers,
-                json=payload,
-                timeout=30
+            aspect_ratio = self._get_aspect_ratio(get_image_size(room_image_path))
+            
+            # Загружаем комнату и мебель на хостинг (ImgBB) параллельно. При недоступности (или KIE_PREFER_DATA_URLS) — data URL
+            print(f"📤 Загрузка изображений комнаты и мебели на хостинг...")
+            return self._run_task(
+                [(room_image_path, "изображение комнаты на хостинг"), (upload_path, "изображение мебели на хостинг")],
+                prompt,
+                aspect_ratio,
+                output_dir
             )
             
-            print(f"📡 HTTP статус: {response.status_code}")
-            
-            response.raise_for_status()
-            result = response.json()
-            
-            print(f"✅ Ответ от Nano Banana Pro получен")
-            print(f"   Код: {result.get('code')}, Сообщение: {result.get('message')}")
-            
-            # Проверяем успешность запроса
-            if result.get('code') != 200:
-                raise ValueError(f"Nano Banana Pro API ошибка: {result.get('message')}")
-            
-            data = result.get('data', {})
-            
-            # Получаем taskId для асинхронной обработки
-            if 'taskId' in data:
-                task_id = data['taskId']
-                print(f"📋 Задача поставлена в очередь, taskId: {task_id}")
-                print(f"⏳ Ожидание завершения обработки...")
-                
-                # Опрашиваем результат
-                result_path = self._query_task_result(task_id, output_dir)
-                return result_path
-            else:
-                raise ValueError("Не получен taskId от API")
-            
         except requests.exceptions.RequestException as e:
             print(f"❌ Ошибка запроса к Nano Banana Pro API: {e}")
             if hasattr(e, 'response') and hasattr(e.response, 'text'):
@@ -391,14 +374,159 @@ TASK: REPLACE the existing furniture in the room with the new furniture from the
             except Exception:
                 pass
     
-    def _query_task_result(self, task_id: str, output_dir: Path, max_attempts: int = 240) -> str:
+    def _run_task(self, images: List[Tuple[str, str]], prompt: str, aspect_ratio: str, output_dir: Path) -> str:
         """
-        Опрашивает результат задачи через Query task API
+        Общая часть всех режимов: кэш результатов и склейка одинаковых запросов, затем задача Kie.ai.
+        
+        Args:
+            images: Пары (путь, что это — для сообщения об ошибке) в порядке image_input
+            prompt: Промпт для Nano Banana Pro
+            aspect_ratio: Соотношение сторон результата
+            output_dir: Директория для сохранения
+            
+        Returns:
+            Путь к результирующему изображению
+        """
+        task_input = {
+            "prompt": prompt,
+            "aspect_ratio": aspect_ratio,
+            "resolution": "1K",  # 1K быстрее; при необходимости можно вернуть 2K
+            "output_format": "png"
+        }
+        task_key = self._task_key([path for path, _ in images], task_input)
+        cached = self._cached_result(task_key, output_dir)
+        if cached:
+            return cached
+        if task_key is None:
+            return self._submit_task(images, task_input, output_dir)
+        
+        # Такая же генерация уже идёт (двойной клик, два пользователя с одними фото) — ждём её результат
+        with _inflight_lock:
+            task = _inflight.get(task_key)
+            leader = task is None
+            if leader:
+                task = _inflight[task_key] = _InflightTask()
+            else:
+                task.waiters += 1
+        if not leader:
+            print(f"⏳ Такая же генерация уже выполняется — ждём её результат")
+            data = task.future.result()
+            result_path = output_dir / f"{uuid.uuid4()}.png"
+            result_path.write_bytes(data)
+            return str(result_path)
+        
+        try:
+            result_path = self._submit_task(images, task_input, output_dir)
+            self._store_result(task_key, result_path)
+            with _inflight_lock:
+                del _inflight[task_key]
+                waiters = task.waiters
+            # Ожидающим — байты результата: свой файл вызывающий потом уменьшает на месте
+            try:
+                task.future.set_result(Path(result_path).read_bytes() if waiters else None)
+            except OSError as e:
+                task.future.set_exception(e)
+            return result_path
+        except BaseException as e:
+            with _inflight_lock:
+                _inflight.pop(task_key, None)
+            if not task.future.done():
+                task.future.set_exception(e)
+            raise
+    
+    def _submit_task(self, images: List[Tuple[str, str]], task_input: Dict[str, Any], output_dir: Path) -> str:
+        """Загрузка изображений → createTask → ожидание результата (без кэша)."""
+        image_paths = [path for path, _ in images]
+        # Первое изображение — всегда комната
+        max_edges = [ROOM_UPLOAD_MAX_EDGE] + [UPLOAD_MAX_EDGE] * (len(image_paths) - 1)
+        image_urls = self._image_urls(image_paths, max_edges)
+        for url, (_, what) in zip(image_urls, images):
+            if not url:
+                raise ValueError(f"Не удалось загрузить {what}")
+        
+        # Подготавливаем payload согласно документации Nano Banana Pro (до 8 изображений в image_input)
+        payload = {
+            "model": self.model_name,
+            "input": {**task_input, "image_input": image_urls}
+        }
+        if self.callback_url:
+            payload["callBackUrl"] = self.callback_url
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        
+        response = self._http.post(self.api_url, headers=headers, json=payload, timeout=30)
+        print(f"📡 HTTP статус: {response.status_code}")
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        
+        if result.get("code") != 200:
+            raise ValueError(f"Nano Banana Pro API: {result.get('message')}")
+        
+        task_id = result.get("data", {}).get("taskId")
+        if not task_id:
+            raise ValueError("Нет taskId в ответе")
+        
+        print(f"📋 Задача поставлена в очередь, taskId: {task_id}")
+        print(f"⏳ Ожидание завершения обработки...")
+        return self._query_task_result(task_id, output_dir)
+    
+    def _task_key(self, image_paths: List[str], task_input: Dict[str, Any]) -> Optional[str]:
+        """Ключ задачи для кэша и склейки одинаковых запросов: blake2b от параметров и содержимого входных изображений."""
+        h = hashlib.blake2b(orjson.dumps({"model": self.model_name, **task_input}, option=orjson.OPT_SORT_KEYS), digest_size=16)
+        try:
+            for path in image_paths:
+                with open(path, 'rb') as f:
+                    h.update(hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).digest())
+        except OSError:
+            return None
+        return h.hexdigest()
+    
+    def _cached_result(self, cache_key: Optional[str], output_dir: Path) -> Optional[str]:
+        """Копия закэшированного результата в output_dir (под новым именем — результат потом уменьшается на месте)."""
+        if cache_key is None or self.result_cache_size <= 0:
+            return None
+        cache_path = RESULT_CACHE_DIR / f"{cache_key}.png"
+        result_path = output_dir / f"{uuid.uuid4()}.png"
+        try:
+            shutil.copyfile(cache_path, result_path)
+            os.utime(cache_path)  # mtime = время последнего использования, по нему вытесняем старые
+        except OSError:
+            return None
+        print(f"♻️  Результат генерации взят из кэша")
+        return str(result_path)
+    
+    def _store_result(self, cache_key: Optional[str], result_path: str) -> None:
+        """Кладёт результат в кэш (через временный файл) и удаляет давно не использованные записи сверх лимита."""
+        if cache_key is None or self.result_cache_size <= 0:
+            return
+        try:
+            RESULT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = RESULT_CACHE_DIR / f"{cache_key}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(result_path, tmp_path)
+            os.replace(tmp_path, RESULT_CACHE_DIR / f"{cache_key}.png")
+            entries = []
+            for entry in os.scandir(RESULT_CACHE_DIR):
+                if entry.name.endswith(".png"):
+                    entries.append((entry.stat().st_mtime, entry.path))
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.result_cache_size)]:
+                os.remove(path)
+        except OSError as e:
+            print(f"⚠️  Не удалось сохранить результат в кэш: {e}")
+    
+    def _query_task_result(self, task_id: str, output_dir: Path, timeout: float = POLL_TIMEOUT) -> str:
+        """
+        Опрашивает результат задачи через Query task API.
+        Интервал растёт от POLL_BASE_DELAY до POLL_MAX_DELAY (задача в очереди), на стадии generating —
+        POLL_GENERATING_DELAY, чтобы заметить завершение без лишней задержки. Callback Kie.ai (KIE_CALLBACK_URL)
+        прерывает паузу досрочно.
         
         Args:
             task_id: ID задачи от Kie.ai
             output_dir: Директория для сохранения
-            max_attempts: Максимальное количество попыток (по умолчанию 240 ≈ 8 мин при интервале 2 сек)
+            timeout: Сколько секунд ждать результат (по умолчанию 8 минут)
             
         Returns:
             Путь к результату
@@ -407,54 +535,92 @@ TASK: REPLACE the existing furniture in the room with the new furniture from the
         headers = {
             "Authorization": f"Bearer {self.api_key}"
         }
-        
-        for attempt in range(max_attempts):
-            try:
-                response = requests.get(
-                    query_url,
-                    headers=headers,
-                    params={"taskId": task_id},
-                    timeout=30
-                )
-                response.raise_for_status()
-                result = response.json()
-                
-                if result.get('code') == 200:
+        deadline = time.monotonic() + timeout
+        last_state = None
+        last_error = None
+        attempt = 0
+        finished = threading.Event()
+        with _task_events_lock:
+            _task_events[task_id] = finished
+        try:
+            while True:
+                state = None
+                try:
+                    response = self._http.get(
+                        query_url,
+                        headers=headers,
+                        params={"taskId": task_id},
+                        timeout=30
+                    )
+                    response.raise_for_status()
+                    result = orjson.loads(response.content)
+                    if result.get('code') != 200:
+                        raise ValueError(f"Ошибка опроса задачи: {result.get('message')}")
                     data = result.get('data', {})
                     state = data.get('state')
-                    
-                    if state == 'success':
-                        print(f"✅ Задача завершена успешно!")
-                        # Результат в поле resultJson
-                        result_json_str = data.get('resultJson')
-                        if result_json_str:
-                            result_json = json.loads(result_json_str)
-                            result_urls = result_json.get('resultUrls', [])
-                            if result_urls and len(result_urls) > 0:
-                                print(f"📥 Скачивание результата по URL...")
-                                return download_image(result_urls[0], output_dir)
-                            else:
-                                raise ValueError(f"В resultJson нет resultUrls: {result_json}")
-                        else:
-                            raise ValueError("Нет поля resultJson в ответе")
-                    elif state == 'fail':
-                        fail_msg = data.get('failMsg', 'Unknown error')
-                        fail_code = data.get('failCode', '')
-                        raise ValueError(f"Задача завершилась с ошибкой [{fail_code}]: {fail_msg}")
-                    else:
-                        # Еще обрабатывается
-                        if attempt % 5 == 0:
-                            print(f"⏳ Статус: {state}, попытка {attempt + 1}/{max_attempts}")
-                        time.sleep(2)
+                except Exception as e:
+                    # Сеть/HTTP/ответ опроса — временная ошибка, опрашиваем дальше
+                    last_error = e
+                
+                if state == 'success':
+                    print(f"✅ Задача завершена успешно!")
+                    # Результат в поле resultJson
+                    result_json_str = data.get('resultJson')
+                    if not result_json_str:
+                        raise ValueError("Нет поля resultJson в ответе")
+                    result_json = orjson.loads(result_json_str)
+                    result_urls = result_json.get('resultUrls', [])
+                    if not result_urls:
+                        raise ValueError(f"В resultJson нет resultUrls: {result_json}")
+                    print(f"📥 Скачивание результата по URL...")
+                    return self._download_result(result_urls[0], output_dir, deadline)
+                if state == 'fail':
+                    fail_msg = data.get('failMsg', 'Unknown error')
+                    fail_code = data.get('failCode', '')
+                    raise ValueError(f"Задача завершилась с ошибкой [{fail_code}]: {fail_msg}")
+                
+                # Ещё обрабатывается — пишем в лог только смену статуса
+                if state is not None and state != last_state:
+                    print(f"⏳ Статус: {state}")
+                    last_state = state
+                
+                if state == 'generating':
+                    delay = POLL_GENERATING_DELAY
                 else:
-                    raise ValueError(f"Ошибка опроса задачи: {result.get('message')}")
-                    
-            except Exception as e:
-                if attempt == max_attempts - 1:
-                    raise Exception(f"Превышено время ожидания результата: {e}")
-                time.sleep(2)
-        
-        raise TimeoutError("Превышено время ожидания результата от Nano Banana Pro")
+                    delay = min(POLL_MAX_DELAY, POLL_BASE_DELAY * 1.5 ** attempt)
+                delay += random.uniform(0, POLL_JITTER)
+                attempt += 1
+                
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # Callback Kie.ai прерывает паузу — сразу опрашиваем снова
+                if finished.wait(min(delay, remaining)):
+                    finished.clear()
+            
+            if last_error is not None:
+                raise TimeoutError(f"Превышено время ожидания результата от Nano Banana Pro: {last_error}")
+            raise TimeoutError("Превышено время ожидания результата от Nano Banana Pro")
+        finally:
+            with _task_events_lock:
+                _task_events.pop(task_id, None)
+    
+    def _download_result(self, url: str, output_dir: Path, deadline: float) -> str:
+        """
+        Скачивает готовый результат. Задача уже выполнена (и оплачена) — сбой CDN (5xx, таймаут, обрыв)
+        не обрывает генерацию: повторяем с растущей паузой до deadline опроса.
+        """
+        attempt = 0
+        while True:
+            try:
+                return download_image(url, output_dir)
+            except OSError as e:  # requests.RequestException и ошибки PIL/диска — подклассы OSError
+                delay = backoff_delay(attempt, POLL_BASE_DELAY, POLL_MAX_DELAY)
+                if time.monotonic() + delay > deadline:
+                    raise TimeoutError(f"Не удалось скачать результат до истечения времени ожидания: {e}")
+                print(f"⏳ Ошибка скачивания результата ({e}), повтор через {delay:.1f} сек...")
+                time.sleep(delay)
+                attempt += 1
     
     def _create_multi_placement_prompt(self, placement_params: Dict[str, Any], num_items: int) -> str:
         """
@@ -467,9 +633,14 @@ TASK: REPLACE the existing furniture in the room with the new furniture from the
         furniture_items = placement_params.get("furniture_items", [])
         base_placement = placement_params.get("placement", {})
         
+        # index -> предмет (первый с таким index, как раньше давал поиск по списку)
+        items_by_index: Dict[Any, Dict[str, Any]] = {}
+        for x in furniture_items:
+            items_by_index.setdefault(x.get("index"), x)
+        
         parts = []
         for idx in range(num_items):
-            item = next((x for x in furniture_items if x.get("index") == idx), None)
+            item = items_by_index.get(idx)
             if item and item.get("placement"):
                 pl = item["placement"]
                 xp = pl.get("x_percent", 50)
@@ -511,61 +682,30 @@ Match the room's {room_lighting}. Add realistic shadows and reflections. Maintai
         room = placement_params.get('room_analysis', {})
         placement = placement_params.get('placement', {})
         
-        furniture_type = furniture.get('type', 'furniture item')
-        furniture_style = furniture.get('style', 'modern')
-        furniture_color = furniture.get('color', 'neutral toned')
-        room_style = room.get('style', 'modern')
-        room_lighting = room.get('lighting', 'natural lighting')
-        reasoning = placement.get('reasoning', '')
         # bbox placement hints (если есть)
         x_percent = placement.get("x_percent")
         y_percent = placement.get("y_percent")
         width_percent = placement.get("width_percent")
         height_percent = placement.get("height_percent")
-        rotation = placement.get("rotation", 0)
-        wall_alignment = placement.get("wall_alignment", "auto")
-        
-        # Промпт с акцентом на сохранение оригинала
-        placement_hint = ""
         if None not in (x_percent, y_percent, width_percent, height_percent):
-            placement_hint = (
-                f"Place the furniture centered at approximately {x_percent:.1f}% from the left and "
-                f"{y_percent:.1f}% from the top. Fit it inside a rectangle of about "
-                f"{width_percent:.1f}% width and {height_percent:.1f}% height of the room image."
-            )
-
-        rotation_hint = ""
-        if rotation == 90:
-            rotation_hint = "The furniture is rotated 90 degrees to match the user's requested orientation (vertical vs horizontal)."
-
-        wall_hint = ""
-        if wall_alignment in ("right", "left", "back"):
-            wall_name = {"right": "right wall", "left": "left wall", "back": "back wall"}[wall_alignment]
-            wall_hint = (
-                f"IMPORTANT: Place the sofa ALONG the {wall_name}, parallel to it, and flush against it. "
-                f"Do NOT place it perpendicular across the room."
+            placement_text = _BBOX_HINT_TEMPLATE.format(
+                x=x_percent, y=y_percent, w=width_percent, h=height_percent
             )
-
-        prompt = f"""Seamlessly integrate the exact {furniture_color} {furniture_type} from the second image into the {room_style} room from the first image.
-
-CRITICAL: Preserve the EXACT appearance of the furniture - same color, texture, and design.
-
-Placement: {placement_hint if placement_hint else (reasoning if reasoning else 'Place it naturally in the room where it fits best')}
-{rotation_hint}
-{wall_hint}
-
-Requirements:
-- Match the room's {room_lighting}
-- Add realistic shadows and reflections
-- Adjust perspective to fit naturally
-- Maintain photorealistic quality
-- Keep furniture IDENTICAL to the original image
-- Blend seamlessly with the interior
-- CRITICAL: Place furniture ON THE FLOOR, standing normally. Do NOT put it on the wall or vertically. Beds horizontal on the floor, chairs/sofas upright with legs on the ground.
-
-Output in high resolution with sharp details."""
+        else:
+            placement_text = placement.get('reasoning', '') or 'Place it naturally in the room where it fits best'
+        
+        wall_name = _WALL_NAMES.get(placement.get("wall_alignment", "auto"))
         
-        return prompt.strip()
+        # Промпт с акцентом на сохранение оригинала
+        return _PLACEMENT_PROMPT_TEMPLATE.format_map({
+            "furniture_color": furniture.get('color', 'neutral toned'),
+            "furniture_type": furniture.get('type', 'furniture item'),
+            "room_style": room.get('style', 'modern'),
+            "room_lighting": room.get('lighting', 'natural lighting'),
+            "placement": placement_text,
+            "rotation_hint": _ROTATION_HINT if placement.get("rotation", 0) == 90 else "",
+            "wall_hint": _WALL_HINT_TEMPLATE.format(wall_name=wall_name) if wall_name else "",
+        })
     
     def _get_aspect_ratio(self, image_size: tuple) -> str:
         """
@@ -581,24 +721,10 @@ Output in high resolution with sharp details."""
         ratio = width / height
         
         # Определяем ближайший стандартный aspect ratio
-        if 0.95 < ratio < 1.05:
-            return "1:1"
-        elif 1.3 < ratio < 1.4:
-            return "4:3"
-        elif 1.5 < ratio < 1.6:
-            return "3:2"
-        elif 1.7 < ratio < 1.9:
-            return "16:9"
-        elif 2.2 < ratio < 2.4:
-            return "21:9"
-        elif 0.6 < ratio < 0.7:
-            return "2:3"
-        elif 0.7 < ratio < 0.8:
-            return "3:4"
-        elif 0.5 < ratio < 0.6:
-            return "9:16"
-        else:
-            return "auto"
+        for low, high, name in _ASPECT_RATIOS:
+            if low < ratio < high:
+                return name
+        return "auto"
     
     def get_model_name(self) -> str:
         """Возвращает название модели"""
@@ -4,10 +4,10 @@
 """
 from pathlib import Path
 from typing import List, Dict, Any
-import json
-import requests
+import orjson
 
 from ..utils.load_env import get_env_variable
+from ..utils.http_session import get_shared_session
 
 
 class UpsellService:
@@ -19,6 +19,7 @@ class UpsellService:
         """Инициализация клиента Kie.ai для Gemini"""
         self.api_key = get_env_variable('KIE_AI_API_KEY')
         self.api_url = "https://api.kie.ai/gemini-2.5-pro/v1/chat/completions"
+        self._http = get_shared_session()
     
     def generate_recommendations(
         self,
@@ -70,7 +71,7 @@ class UpsellService:
                 "Content-Type": "application/json"
             }
             
-            response = requests.post(
+            response = self._http.post(
                 self.api_url,
                 headers=headers,
                 json=payload,
@@ -78,7 +79,7 @@ class UpsellService:
             )
             
             response.raise_for_status()
-            result = response.json()
+            result = orjson.loads(response.content)
             
             # Извлекаем ответ
             if 'choices' in result and len(result['choices']) > 0:
@@ -181,7 +182,7 @@ class UpsellService:
             else:
                 json_str = content.strip()
             
-            data = json.loads(json_str)
+            data = orjson.loads(json_str)
             recommendations = []
             seen_ids = set()
             
@@ -0,0 +1,72 @@
+"""
+HTTP-сессии для внешних API (Kie.ai, Remove.bg, ImgBB).
+Сессия держит keep-alive соединения в пуле: повторные запросы к тому же хосту
+не тратят время на DNS и TLS-рукопожатие.
+"""
+import random
+import threading
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_shared_session: Optional[requests.Session] = None
+_shared_lock = threading.Lock()
+
+
+def create_session(
+    headers: Optional[Dict[str, str]] = None,
+    pool_connections: int = 4,
+    pool_maxsize: int = 10
+) -> requests.Session:
+    """
+    Создаёт requests.Session с пулом соединений.
+
+    Повторяются только ошибки установки соединения (запрос ещё не ушёл, повтор безопасен и для POST);
+    ответы API и таймауты чтения обрабатывают сами сервисы.
+
+    Args:
+        headers: Заголовки, общие для всех запросов сессии (например, Authorization)
+        pool_connections: Сколько хостов держать в пуле
+        pool_maxsize: Сколько соединений на хост (≈ число потоков, вызывающих сервис одновременно)
+    """
+    session = requests.Session()
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3, allowed_methods=None)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def get_shared_session() -> requests.Session:
+    """
+    Общая на процесс сессия (создаётся при первом вызове).
+    Сервисы, которые ходят на один и тот же хост (api.kie.ai), делят пул keep-alive соединений;
+    заголовки авторизации передаются в каждом запросе, сессия их не хранит.
+    """
+    global _shared_session
+    if _shared_session is None:
+        with _shared_lock:
+            if _shared_session is None:
+                _shared_session = create_session(pool_maxsize=20)
+    return _shared_session
+
+
+def close_shared_session() -> None:
+    """Закрывает общую сессию (соединения пула) при остановке приложения; следующий вызов создаст новую."""
+    global _shared_session
+    with _shared_lock:
+        session, _shared_session = _shared_session, None
+    if session is not None:
+        session.close()
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 30.0, jitter: float = 0.5) -> float:
+    """
+    Пауза перед повтором: экспонента base·2^attempt (не больше cap) со случайной добавкой до jitter·100%.
+    Одновременные запросы не повторяются синхронно и не перегружают только что поднявшийся API.
+    """
+    return min(cap, base * (2 ** attempt)) * (1 + random.uniform(0, jitter))
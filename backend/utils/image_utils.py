@@ -1,21 +1,34 @@
 """
 Утилиты для работы с изображениями
 """
+import asyncio
 import base64
 import io
+import os
+import shutil
 import uuid
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Tuple, Optional, List
+from typing import Tuple, Optional, List, Union, BinaryIO
 from PIL import Image
-import requests
 
+from .http_session import get_shared_session
 
-def save_uploaded_image(image_data: bytes, upload_dir: Path) -> str:
+# Размер блока при копировании загрузок на диск
+UPLOAD_COPY_CHUNK = 1 << 20
+
+# Размер блока при скачивании результата
+DOWNLOAD_CHUNK = 1 << 16
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def save_uploaded_image(image_data: Union[bytes, BinaryIO], upload_dir: Path) -> str:
     """
     Сохраняет загруженное изображение
     
     Args:
-        image_data: Байты изображения
+        image_data: Байты изображения или файловый объект (например, спул UploadFile)
         upload_dir: Директория для сохранения
         
     Returns:
@@ -25,8 +38,27 @@ def save_uploaded_image(image_data: bytes, upload_dir: Path) -> str:
     filename = f"{uuid.uuid4()}.png"
     filepath = upload_dir / filename
     
-    # Открываем и конвертируем в PNG
-    image = Image.open(io.BytesIO(image_data))
+    # Открываем и конвертируем в PNG (PIL читает файл по частям, без копии в bytes)
+    if isinstance(image_data, (bytes, bytearray)):
+        image_data = io.BytesIO(image_data)
+    image = Image.open(image_data)
+    
+    # Уже RGB PNG — перекодировать нечего: копируем файл как есть, кусками по 1 МБ.
+    # verify() проходит все чанки до IEND с проверкой CRC (без декодирования пикселей): обрезанный
+    # или битый файл с целым заголовком не копируется, а идёт в обычный путь, где декодер выдаст ошибку
+    if image.format == 'PNG' and image.mode == 'RGB' and not getattr(image, 'is_animated', False):
+        try:
+            image.verify()
+            verified = True
+        except Exception:
+            verified = False
+        image_data.seek(0)
+        if verified:
+            with open(filepath, 'wb') as out:
+                shutil.copyfileobj(image_data, out, UPLOAD_COPY_CHUNK)
+            return str(filepath)
+        # После verify() объект изображения непригоден — открываем заново
+        image = Image.open(image_data)
     
     # Конвертируем RGBA в RGB если нужно
     if image.mode == 'RGBA':
@@ -42,6 +74,24 @@ def save_uploaded_image(image_data: bytes, upload_dir: Path) -> str:
     return str(filepath)
 
 
+async def save_upload_file(upload_file, upload_dir: Path, executor: Optional[Executor] = None) -> Tuple[str, str]:
+    """
+    Сохраняет UploadFile, не читая тело целиком в память.
+    Starlette уже держит загрузку во временном (спул) файле — PIL читает прямо из него,
+    а декодирование и запись на диск идут в пуле потоков, не блокируя event loop.
+    
+    Args:
+        executor: Пул для декодирования и записи (None — пул по умолчанию event loop)
+    
+    Returns:
+        (путь к сохраненному файлу, имя файла)
+    """
+    await upload_file.seek(0)
+    loop = asyncio.get_running_loop()
+    file_path = await loop.run_in_executor(executor, save_uploaded_image, upload_file.file, upload_dir)
+    return file_path, os.path.basename(file_path)
+
+
 def image_to_base64(image_path: str) -> str:
     """
     Конвертирует изображение в base64 для API
@@ -70,6 +120,16 @@ def image_to_data_url(image_path: str) -> str:
     return f"data:image/png;base64,{base64_image}"
 
 
+def get_image_size(image_path: str) -> Tuple[int, int]:
+    """
+    Возвращает (ширина, высота) изображения.
+    PIL при открытии читает только заголовок файла — пиксели не декодируются,
+    а файл сразу закрывается.
+    """
+    with Image.open(image_path) as img:
+        return img.size
+
+
 def create_furniture_collage(
     image_paths: List[str],
     output_path: str,
@@ -179,16 +239,30 @@ def download_image(url: str, save_path: Path) -> str:
     Returns:
         Путь к сохраненному файлу
     """
-    response = requests.get(url, timeout=30)
-    response.raise_for_status()
-    
     # Создаем уникальное имя
     filename = f"{uuid.uuid4()}.png"
     filepath = save_path / filename
+    tmp_path = save_path / f"{filename}.part"
     
-    # Открываем и сохраняем
-    image = Image.open(io.BytesIO(response.content))
-    image.save(filepath, 'PNG')
+    # Пишем на диск по мере получения (keep-alive сессия, без копии файла целиком в памяти)
+    try:
+        with get_shared_session().get(url, timeout=30, stream=True) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                    f.write(chunk)
+        
+        with open(tmp_path, 'rb') as f:
+            is_png = f.read(len(PNG_SIGNATURE)) == PNG_SIGNATURE
+        if is_png:
+            # Уже PNG — сохраняем как есть, без декодирования и повторного сжатия
+            os.replace(tmp_path, filepath)
+        else:
+            with Image.open(tmp_path) as image:
+                image.save(filepath, 'PNG')
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
     
     return str(filepath)
 
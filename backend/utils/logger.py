@@ -0,0 +1,44 @@
+"""
+Логгер приложения.
+Обработчики запросов только кладут запись в очередь (QueueHandler),
+а форматирование и вывод в stdout выполняет отдельный поток (QueueListener).
+"""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+ROOT_LOGGER_NAME = "mebel"
+
+_listener: Optional[QueueListener] = None
+
+
+def _setup() -> None:
+    """Один раз подключает очередь к корневому логгеру приложения."""
+    global _listener
+    if _listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    _listener = QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_queue))
+    root.propagate = False
+
+
+def get_logger(name: str = ROOT_LOGGER_NAME) -> logging.Logger:
+    """
+    Возвращает логгер приложения (дочерний для "mebel").
+    Используйте %-аргументы: logger.info("Файл: %s", path) — строка
+    форматируется только если уровень не отфильтрован.
+    """
+    _setup()
+    if name != ROOT_LOGGER_NAME and not name.startswith(ROOT_LOGGER_NAME + "."):
+        name = f"{ROOT_LOGGER_NAME}.{name}"
+    return logging.getLogger(name)
@@ -30,7 +30,7 @@ source backend/venv/bin/activate
 
 # Запуск backend
 echo "🚀 Запуск backend сервера на http://localhost:8000"
-PYTHONPATH="${PWD}" uvicorn backend.app:app --reload --host 0.0.0.0 --port 8000 &
+PYTHONPATH="${PWD}" uvicorn backend.app:app --reload --host 0.0.0.0 --port 8000 --loop uvloop --http httptools &
 BACKEND_PID=$!
 
 # Ждем пока backend запустится